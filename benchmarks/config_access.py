@@ -0,0 +1,102 @@
+"""
+Benchmark config element access.
+
+Compares the cost per access of the legacy lookup, which re-parsed the
+element spec and the config file value on every read, against the
+compiled accessors with and without the value cache.
+
+    python benchmarks/config_access.py --iterations 200000
+"""
+
+import os
+import timeit
+import argparse
+import tempfile
+
+from ebs.linuxnode.core.config import ElementSpec
+from ebs.linuxnode.core.config import ItemSpec
+
+
+def _legacy_lookup(config, element):
+    # The lookup as it was done by IoTNodeConfig.__getattr__ before
+    # elements were compiled.
+    section, item, item_spec = config._elements[element]
+    item_type, fallback, read_only, masked = item_spec
+    kwargs = {}
+    if callable(fallback):
+        fallback = fallback(config)
+    if not fallback == "_required":
+        kwargs['fallback'] = fallback
+    if section == '_derived':
+        return item(config)
+    if item_type == str:
+        return config._config.get(section, item, **kwargs)
+    elif item_type == bool:
+        return config._config.getboolean(section, item, **kwargs)
+    elif item_type == int:
+        return config._config.getint(section, item, **kwargs)
+    elif item_type == float:
+        return config._config.getfloat(section, item, **kwargs)
+
+
+def _proxy_url(config):
+    url = config.proxy_host
+    if config.proxy_port:
+        url = "{0}:{1}".format(url, config.proxy_port)
+    return url
+
+
+def _make_config():
+    os.environ['XDG_CONFIG_HOME'] = tempfile.mkdtemp()
+    from ebs.linuxnode.core.config import IoTNodeConfig
+    config = IoTNodeConfig(appname='config-benchmark')
+    _elements = {
+        'prefetch_retries': ElementSpec('resources', 'prefetch_retries', ItemSpec(int, fallback=6)),
+        'cache_max_size': ElementSpec('cache', 'max_size', ItemSpec(int, fallback=lambda c: 10 ** 9)),
+        'proxy_host': ElementSpec('http', 'proxy_host', ItemSpec(fallback='proxy.local')),
+        'proxy_port': ElementSpec('http', 'proxy_port', ItemSpec(int, fallback=3128)),
+        'proxy_url': ElementSpec('_derived', _proxy_url),
+    }
+    for name, spec in _elements.items():
+        config.register_element(name, spec)
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=200000)
+    args = parser.parse_args()
+    n = args.iterations
+    config = _make_config()
+
+    def _legacy_derived():
+        # Derived elements chained legacy lookups for each dependency.
+        url = _legacy_lookup(config, 'proxy_host')
+        if _legacy_lookup(config, 'proxy_port'):
+            url = "{0}:{1}".format(url, _legacy_lookup(config, 'proxy_port'))
+        return url
+
+    print("{0:>18} {1:>14} {2:>14} {3:>14}".format(
+        'element', 'legacy (ns)', 'compiled (ns)', 'cached (ns)'))
+    for element in ['prefetch_retries', 'cache_max_size', 'proxy_url']:
+        if element == 'proxy_url':
+            legacy = timeit.timeit(_legacy_derived, number=n)
+        else:
+            legacy = timeit.timeit(lambda: _legacy_lookup(config, element), number=n)
+
+        accessor = config._accessors[element]
+
+        def _compiled():
+            config.invalidate()
+            return accessor(config)
+        invalidate_cost = timeit.timeit(config.invalidate, number=n)
+        compiled = timeit.timeit(_compiled, number=n) - invalidate_cost
+
+        getattr(config, element)
+        cached = timeit.timeit(lambda: getattr(config, element), number=n)
+        print("{0:>18} {1:>14.0f} {2:>14.0f} {3:>14.0f}".format(
+            element, legacy / n * 1e9, compiled / n * 1e9, cached / n * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark body collectors against a local HTTP server.
+
+Downloads a file of the given size from a python http.server running in a
+separate process, once with the legacy WatchfulBodyCollector and once with
+the StreamingBodyCollector, and reports the peak number of live reactor
+DelayedCalls and the CPU time spent in this process per GB received.
+
+    python benchmarks/http_collector.py --size 512
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import succeed
+from twisted.web.client import Agent
+from treq.client import HTTPClient
+
+from ebs.linuxnode.core.http import watchful_collect
+from ebs.linuxnode.core.collector import streaming_collect
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _make_file(directory, size_mb):
+    path = os.path.join(directory, 'payload.bin')
+    chunk = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(chunk)
+    return path
+
+
+def _run(client, url, collect):
+    results = {}
+    peak = [0]
+
+    def _sample():
+        peak[0] = max(peak[0], len(reactor.getDelayedCalls()))
+    sampler = LoopingCall(_sample)
+    sampler.start(0.01)
+
+    sink = open(os.devnull, 'wb')
+    start_cpu = time.process_time()
+    start_wall = time.monotonic()
+
+    d = client.get(url, unbuffered=True)
+    d.addCallback(lambda response: collect(response, sink.write))
+
+    def _done(_):
+        sampler.stop()
+        sink.close()
+        results['cpu'] = time.process_time() - start_cpu
+        results['wall'] = time.monotonic() - start_wall
+        results['peak_delayed_calls'] = peak[0]
+        return results
+    d.addCallback(_done)
+    return d
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256, help="Payload size in MB")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    _make_file(directory, args.size)
+    port = _free_port()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'http.server', str(port), '--bind', '127.0.0.1',
+         '--directory', directory],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    time.sleep(1)
+    url = 'http://127.0.0.1:{0}/payload.bin'.format(port)
+    client = HTTPClient(Agent(reactor))
+    gb = args.size / 1024
+
+    # The legacy collector leaves its timers behind for chunktimeout
+    # seconds after the transfer, so it is run last.
+    collectors = [
+        ('streaming', lambda r, c: streaming_collect(r, c, reactor, idle_timeout=10)),
+        ('watchful', lambda r, c: watchful_collect(r, c, chunktimeout=10, reactor=reactor)),
+    ]
+    reports = []
+    d = succeed(None)
+    for name, collect in collectors:
+        def _next(_, name=name, collect=collect):
+            rd = _run(client, url, collect)
+            rd.addCallback(lambda results: reports.append((name, results)))
+            return rd
+        d.addCallback(_next)
+
+    def _finish(_):
+        print("{0:>10} {1:>12} {2:>12} {3:>14}".format(
+            'collector', 'wall (s)', 'cpu s/GB', 'peak timers'))
+        for name, r in reports:
+            print("{0:>10} {1:>12.2f} {2:>12.2f} {3:>14}".format(
+                name, r['wall'], r['cpu'] / gb, r['peak_delayed_calls']))
+
+    def _stop(_):
+        server.terminate()
+        reactor.stop()
+    d.addCallback(_finish)
+    d.addErrback(lambda f: print(f))
+    d.addBoth(_stop)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
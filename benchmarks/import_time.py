@@ -0,0 +1,75 @@
+"""
+Benchmark the import time of the node.
+
+Imports the given module in fresh interpreters with -X importtime and
+reports the median total import time along with the slowest imports.
+It also checks that modules which should only be loaded on first use
+were not imported. The exit status is non-zero if a forbidden module was
+imported or the median exceeds --max-ms, so this can be used to catch
+startup regressions.
+
+    python benchmarks/import_time.py --runs 5 --max-ms 500
+"""
+
+import sys
+import argparse
+import statistics
+import subprocess
+
+
+# Heavy dependencies which are imported lazily by the features that need
+# them, and should never be loaded just by importing the node.
+LAZY_MODULES = ['sqlalchemy', 'treq', 'psutil', 'netifaces', 'pkg_resources']
+
+
+def _import_times(module):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {0}'.format(module)],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        universal_newlines=True, check=True
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='ebs.linuxnode.core.basenode')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help="Fail if the median import time exceeds this")
+    args = parser.parse_args()
+
+    runs = [_import_times(args.module) for _ in range(args.runs)]
+    totals = [r[args.module][1] / 1000 for r in runs]
+    median = statistics.median(totals)
+    print("{0} : median {1:.1f} ms over {2} runs (min {3:.1f}, max {4:.1f})".format(
+        args.module, median, args.runs, min(totals), max(totals)))
+
+    print("\nSlowest imports by self time (last run) :")
+    last = runs[-1]
+    for name, (self_us, cumulative_us) in sorted(
+            last.items(), key=lambda x: x[1][0], reverse=True)[:args.top]:
+        print("{0:>10.1f} ms {1:>10.1f} ms  {2}".format(
+            self_us / 1000, cumulative_us / 1000, name))
+
+    failed = False
+    loaded = [m for m in LAZY_MODULES if m in last]
+    if loaded:
+        print("\nModules which should be lazily imported were loaded : "
+              "{0}".format(', '.join(loaded)))
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print("\nMedian import time exceeds {0} ms".format(args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
-
 __author__ = 'Chintalagiri Shashank <shashank.chintalagiri@gmail.com>'
 
-from pkg_resources import get_distribution, DistributionNotFound
-try:
-    __version__ = get_distribution('ebs-linuxnode-core').version
-except DistributionNotFound:
-    # package is not installed
-    from setuptools_scm import get_version
-    __version__ = get_version(root='../../../', relative_to=__file__)
+
+def _get_version():
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version('ebs-linuxnode-core')
+    except PackageNotFoundError:
+        # package is not installed
+        from setuptools_scm import get_version
+        return get_version(root='../../../', relative_to=__file__)
+
+
+def __getattr__(name):
+    # The version is looked up on first access rather than on import,
+    # since reading distribution metadata is slow on constrained devices.
+    if name == '__version__':
+        global __version__
+        __version__ = _get_version()
+        return __version__
+    raise AttributeError(name)
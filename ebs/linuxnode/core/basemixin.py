@@ -8,8 +8,23 @@ from appdirs import user_cache_dir
 from appdirs import user_config_dir
 from twisted.internet import reactor
 
+from .boot import boot_tracer
+
 
 class BaseMixin(object):
+    _boot_traced_hooks = ('__init__', 'install', 'start')
+
+    def __init_subclass__(cls, **kwargs):
+        # Wrap the lifecycle hooks defined by each mixin so that their
+        # durations appear in the boot report.
+        super(BaseMixin, cls).__init_subclass__(**kwargs)
+        for hook in cls._boot_traced_hooks:
+            method = cls.__dict__.get(hook)
+            if method is None or getattr(method, '_boot_traced', False):
+                continue
+            name = '{0}.{1}'.format(cls.__name__, hook)
+            setattr(cls, hook, boot_tracer.traced(name)(method))
+
     def __init__(self, *args, **kwargs):
         self._reactor = kwargs.pop('reactor', reactor)
         self._cache_dir = None
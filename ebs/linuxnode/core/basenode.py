@@ -11,6 +11,8 @@ from .http import HttpClientMixin
 from .resources import ResourceManagerMixin
 from .background import BackgroundCoreMixin
 from .tempfs import TempFSMixin
+from .configwatch import ConfigWatcher
+from .boot import boot_tracer
 
 
 class BaseIoTNode(BackgroundCoreMixin,
@@ -24,6 +26,7 @@ class BaseIoTNode(BackgroundCoreMixin,
     _has_gui = False
 
     def __init__(self, *args, **kwargs):
+        self._config_watcher = None
         super(BaseIoTNode, self).__init__(*args, **kwargs)
 
     def install(self):
@@ -34,10 +37,37 @@ class BaseIoTNode(BackgroundCoreMixin,
     def start(self):
         super(BaseIoTNode, self).start()
         self.log.info("Starting Node with ID {id}", id=self.id)
+        if self.config.config_hot_reload:
+            self._config_watcher = ConfigWatcher(self.config, self.reactor)
+            self._config_watcher.start()
+        boot_tracer.mark('node_started')
+        # Deferred so that the start() phases of subclasses are complete
+        # by the time the report is written.
+        self.reactor.callLater(0, self.boot_report_write)
+
+    @property
+    def boot_tracer(self):
+        return boot_tracer
+
+    def boot_report_write(self):
+        # Writes the boot report to the log directory, where it is
+        # included in log packages. Applications may call this again
+        # after recording later marks, such as the first frame.
+        path = os.path.join(self.log_dir, 'boot.json')
+        boot_tracer.write_report(path)
+        self.log.info("Node started {t:.3f}s after process start. "
+                      "Boot report written to {path}",
+                      t=boot_tracer.now(), path=path)
+        for phase in boot_tracer.slowest(5):
+            self.log.debug("  {t:8.3f}s  {name}", t=phase['self'], name=phase['name'])
 
     def stop(self):
         super(BaseIoTNode, self).stop()
         self.log.info("Stopping Node with ID {id}", id=self.id)
+        if self._config_watcher:
+            self._config_watcher.stop()
+            self._config_watcher = None
+        self.config.flush()
 
     def exit(self):
         self.stop()
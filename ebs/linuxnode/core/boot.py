@@ -0,0 +1,125 @@
+
+
+import os
+import json
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+
+def _process_start():
+    # Monotonic timestamp of the start of this process, so that the boot
+    # report includes interpreter startup and imports. Falls back to the
+    # time this module was imported where /proc is not available.
+    now = time.monotonic()
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        # The process name may contain spaces, so split after it.
+        started = int(stat.rsplit(')', 1)[1].split()[19])
+        age = uptime - started / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return now
+    return now - max(age, 0)
+
+
+class BootTracer(object):
+    # Records timed phases of node startup.
+    #
+    # Phases nest. Each records its depth and parent, per thread, so that
+    # the report can attribute self time to each phase separately from
+    # the phases it contains. Lifecycle hooks of all BaseMixin subclasses
+    # are traced automatically, see BaseMixin.__init_subclass__. Lazily
+    # initialized subsystems trace their initialization explicitly using
+    # phase(). Point events such as the node having started or the first
+    # frame having been rendered are recorded with mark().
+    #
+    # Times are in seconds since the start of the process.
+    def __init__(self):
+        self.origin = _process_start()
+        self._records = []
+        self._marks = []
+        self._local = threading.local()
+        self.mark('imported')
+
+    def now(self):
+        return time.monotonic() - self.origin
+
+    @contextmanager
+    def phase(self, name):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        record = {
+            'name': name,
+            'start': self.now(),
+            'end': None,
+            'depth': len(stack),
+            'parent': stack[-1]['id'] if stack else None,
+            'thread': threading.current_thread().name,
+            'id': len(self._records),
+        }
+        self._records.append(record)
+        stack.append(record)
+        try:
+            yield record
+        finally:
+            stack.pop()
+            record['end'] = self.now()
+
+    def traced(self, name):
+        def _decorator(func):
+            @wraps(func)
+            def _traced(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+            _traced._boot_traced = True
+            return _traced
+        return _decorator
+
+    def mark(self, name):
+        self._marks.append({'name': name, 'time': self.now()})
+
+    def report(self):
+        children = {}
+        for record in self._records:
+            if record['end'] is None or record['parent'] is None:
+                continue
+            duration = record['end'] - record['start']
+            children[record['parent']] = children.get(record['parent'], 0) + duration
+        phases = []
+        for record in self._records:
+            if record['end'] is None:
+                continue
+            duration = record['end'] - record['start']
+            phases.append({
+                'name': record['name'],
+                'start': record['start'],
+                'duration': duration,
+                'self': duration - children.get(record['id'], 0),
+                'depth': record['depth'],
+                'thread': record['thread'],
+            })
+        return {
+            'pid': os.getpid(),
+            'generated': self.now(),
+            'marks': list(self._marks),
+            'phases': phases,
+        }
+
+    def slowest(self, n=10):
+        phases = self.report()['phases']
+        return sorted(phases, key=lambda x: x['self'], reverse=True)[:n]
+
+    def write_report(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp_path, path)
+        return path
+
+
+boot_tracer = BootTracer()
@@ -0,0 +1,223 @@
+
+
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.internet.error import TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.python.failure import Failure
+from twisted.protocols.policies import TimeoutMixin
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+
+
+class TransferStats(object):
+    def __init__(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.started = None
+        self.finished = None
+        self.stalls = 0
+        self.stall_time = 0
+        self.timed_out = False
+
+    @property
+    def elapsed(self):
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def throughput(self):
+        if not self.elapsed:
+            return None
+        return self.bytes / self.elapsed
+
+    def as_dict(self):
+        return {
+            'bytes': self.bytes,
+            'chunks': self.chunks,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+            'timed_out': self.timed_out,
+        }
+
+
+class TransferMetrics(object):
+    # Aggregate of TransferStats across all completed transfers.
+    def __init__(self):
+        self.transfers = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.bytes = 0
+        self.elapsed = 0
+        self.stalls = 0
+        self.stall_time = 0
+
+    def record(self, stats, success=True):
+        self.transfers += 1
+        if not success:
+            self.failures += 1
+        if stats.timed_out:
+            self.timeouts += 1
+        self.bytes += stats.bytes
+        self.elapsed += stats.elapsed or 0
+        self.stalls += stats.stalls
+        self.stall_time += stats.stall_time
+
+    @property
+    def throughput(self):
+        if not self.elapsed:
+            return None
+        return self.bytes / self.elapsed
+
+    def as_dict(self):
+        return {
+            'transfers': self.transfers,
+            'failures': self.failures,
+            'timeouts': self.timeouts,
+            'bytes': self.bytes,
+            'elapsed': self.elapsed,
+            'throughput': self.throughput,
+            'stalls': self.stalls,
+            'stall_time': self.stall_time,
+        }
+
+
+class StreamingBodyCollector(Protocol, TimeoutMixin):
+    # Body collector with constant timer overhead per transfer.
+    #
+    #  - idle_timeout is implemented with a single DelayedCall which is
+    #    reset as data arrives, instead of scheduling a new one per chunk.
+    #  - deadline, if provided, bounds the total duration of the transfer.
+    #  - If the collector returns a Deferred, the transport is paused until
+    #    the outstanding writes drop below max_pending chunks. Slow sinks
+    #    therefore push back on the network instead of buffering in memory.
+    #    The idle timeout does not run while the transport is paused, and
+    #    finished only fires once every outstanding write has completed.
+    #  - Gaps between chunks longer than stall_threshold are counted as
+    #    stalls in the transfer stats.
+    def __init__(self, finished, collector, reactor, idle_timeout=None,
+                 deadline=None, stall_threshold=2, max_pending=4,
+                 stats=None, metrics=None):
+        self.finished = finished
+        self.collector = collector
+        self.reactor = reactor
+        self.idle_timeout = idle_timeout
+        self.deadline = deadline
+        self.stall_threshold = stall_threshold
+        self.max_pending = max_pending
+        self.stats = stats or TransferStats()
+        self.metrics = metrics
+        self._deadline_call = None
+        self._last_data = None
+        self._pending = 0
+        self._paused = False
+        self._sink_failure = None
+        self._lost = None
+
+    def callLater(self, period, func):
+        return self.reactor.callLater(period, func)
+
+    def connectionMade(self):
+        now = self.reactor.seconds()
+        self.stats.started = now
+        self._last_data = now
+        self.setTimeout(self.idle_timeout)
+        if self.deadline is not None:
+            self._deadline_call = self.reactor.callLater(
+                self.deadline, self.timeoutConnection
+            )
+
+    def dataReceived(self, data):
+        now = self.reactor.seconds()
+        gap = now - self._last_data
+        if self.stall_threshold is not None and gap > self.stall_threshold:
+            self.stats.stalls += 1
+            self.stats.stall_time += gap
+        self._last_data = now
+        self.stats.bytes += len(data)
+        self.stats.chunks += 1
+        self.resetTimeout()
+
+        result = self.collector(data)
+        if isinstance(result, Deferred):
+            self._pending += 1
+            if self._pending >= self.max_pending and not self._paused:
+                self._paused = True
+                # Waiting on the sink is not idleness of the connection.
+                self.setTimeout(None)
+                self.transport.pauseProducing()
+            result.addBoth(self._written)
+
+    def _written(self, result):
+        self._pending -= 1
+        if isinstance(result, Failure):
+            # The sink could not keep the data. There is no point in
+            # receiving the rest of the body.
+            if self._sink_failure is None:
+                self._sink_failure = result
+                if self._lost is None:
+                    self.transport.loseConnection()
+            result = None
+        elif self._paused and self._pending < self.max_pending and \
+                self._lost is None:
+            self._paused = False
+            self._last_data = self.reactor.seconds()
+            self.setTimeout(self.idle_timeout)
+            self.transport.resumeProducing()
+        if self._lost is not None and not self._pending:
+            self._finish(self._lost)
+        return result
+
+    def timeoutConnection(self):
+        self.stats.timed_out = True
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.setTimeout(None)
+        if self._deadline_call and self._deadline_call.active():
+            self._deadline_call.cancel()
+        self._deadline_call = None
+        self._lost = reason
+        if not self._pending:
+            self._finish(reason)
+
+    def _finish(self, reason):
+        self.stats.finished = self.reactor.seconds()
+
+        if self._sink_failure is not None:
+            success = False
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            # http://twistedmatrix.com/trac/ticket/4840
+            success = True
+        else:
+            success = False
+        if self.metrics is not None:
+            self.metrics.record(self.stats, success=success)
+
+        if success:
+            self.finished.callback(self.stats)
+        elif self._sink_failure is not None:
+            self.finished.errback(self._sink_failure)
+        elif self.stats.timed_out:
+            self.finished.errback(TimeoutError(
+                "Body transfer timed out after {0} bytes".format(self.stats.bytes)
+            ))
+        else:
+            self.finished.errback(reason)
+
+
+def streaming_collect(response, collector, reactor, idle_timeout=None,
+                      deadline=None, stats=None, metrics=None, **kwargs):
+    if response.length == 0:
+        return succeed(stats or TransferStats())
+
+    d = Deferred()
+    response.deliverBody(
+        StreamingBodyCollector(d, collector, reactor,
+                               idle_timeout=idle_timeout, deadline=deadline,
+                               stats=stats, metrics=metrics, **kwargs)
+    )
+    return d
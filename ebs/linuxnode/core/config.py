@@ -8,12 +8,18 @@
 
 
 import os
+import sys
+import atexit
 import shutil
-import pkg_resources
+import tempfile
+import threading
+import traceback
 
+from io import StringIO
 from pathlib import Path
 from six.moves.configparser import ConfigParser
 from collections import namedtuple
+from contextlib import contextmanager
 from appdirs import user_config_dir
 from configparser import NoSectionError
 
@@ -26,6 +32,16 @@ ElementSpec = namedtuple('ElementSpec', ['section', 'item', 'item_spec'], defaul
 class IoTNodeConfig(object):
     def __init__(self, appname=None, packagename=None):
         self._elements = {}
+        self._accessors = {}
+        self._cached = set()
+        self._dirty = False
+        self._generation = 0
+        self._written_generation = 0
+        self._write_lock = threading.Lock()
+        self._write_call = None
+        self._transaction_depth = 0
+        self._last_written = None
+        self._change_callbacks = {}
         self._packagename = packagename
         self._appname = appname or 'iotnode'
         _root = os.path.abspath(os.path.dirname(__file__))
@@ -33,8 +49,8 @@ class IoTNodeConfig(object):
         self._config = ConfigParser()
         print("Reading Config File {}".format(self._config_file))
         self._config.read(self._config_file)
-        print("EBS IOT Linux Node Core, version {0}".format(self.linuxnode_core_version))
         self._config_init()
+        atexit.register(self.flush)
 
     @property
     def appname(self):
@@ -88,22 +104,122 @@ class IoTNodeConfig(object):
 
     @property
     def linuxnode_core_version(self):
-        return pkg_resources.get_distribution('ebs-linuxnode-core').version
+        from . import __version__
+        return __version__
 
     @property
     def app_version(self):
         if not self._packagename:
             return
-        return pkg_resources.get_distribution(self._packagename).version
+        from importlib.metadata import version
+        return version(self._packagename)
+
+    # Config Writes
+    #
+    # Changes are not written out immediately. They mark the config as
+    # dirty and schedule a flush write_delay seconds later, so that a
+    # burst of changes results in a single write. Within a transaction()
+    # nothing is scheduled, and the changes are flushed together when the
+    # outermost transaction exits.
+    #
+    # The file is replaced atomically by writing a temporary file in the
+    # same directory, fsyncing it and renaming it over config.ini. A
+    # power loss during a write therefore leaves either the old or the
+    # new file, never a truncated one.
+    #
+    # Coalescing and off-thread writes need a running reactor. Before the
+    # reactor is started, and after it has stopped, changes are written
+    # synchronously. Any pending changes are also flushed at exit.
+    @staticmethod
+    def _running_reactor():
+        # The reactor is never imported from here. Doing so would install
+        # the default reactor before the application gets to install its
+        # own.
+        reactor = sys.modules.get('twisted.internet.reactor')
+        if reactor is not None and reactor.running:
+            return reactor
 
     def _write_config(self):
-        with open(self._config_file, 'w') as configfile:
-            self._config.write(configfile)
+        self._dirty = True
+        self._generation += 1
+        if self._transaction_depth:
+            return
+        reactor = self._running_reactor()
+        if reactor is None:
+            self.flush()
+        elif self._write_call is None or not self._write_call.active():
+            self._write_call = reactor.callLater(self.config_write_delay, self.flush)
+
+    def flush(self):
+        if self._write_call is not None and self._write_call.active():
+            self._write_call.cancel()
+        self._write_call = None
+        if not self._dirty:
+            return
+        self._dirty = False
+        content = self._serialize()
+        reactor = self._running_reactor()
+        if reactor is None:
+            self._write_atomic(content, self._generation)
+        else:
+            reactor.callInThread(self._write_atomic, content, self._generation)
+
+    def _serialize(self):
+        # Runs in the thread which owns the config, so the parser is never
+        # read while it is being modified.
+        buffer = StringIO()
+        self._config.write(buffer)
+        return buffer.getvalue()
+
+    def _write_atomic(self, content, generation):
+        with self._write_lock:
+            if generation <= self._written_generation:
+                # A newer snapshot has already been written.
+                return
+            directory = os.path.dirname(self._config_file)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.config.', suffix='.tmp')
+            try:
+                try:
+                    mode = os.stat(self._config_file).st_mode & 0o777
+                except FileNotFoundError:
+                    mode = 0o644
+                os.fchmod(fd, mode)
+                with os.fdopen(fd, 'w') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # Recorded before the rename so that the config watcher
+                # can recognize the resulting file event as our own.
+                self._last_written = content
+                os.replace(tmp_path, self._config_file)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                pass
+            else:
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            self._written_generation = generation
+
+    @contextmanager
+    def transaction(self):
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if not self._transaction_depth and self._dirty:
+                self.flush()
 
     def _check_section(self, section):
         if not self._config.has_section(section):
             self._config.add_section(section)
-            self._write_config()
 
     def _parse_color(self, value, on_error='auto'):
         color = value.split(':')
@@ -130,35 +246,129 @@ class IoTNodeConfig(object):
 
     def register_application_root(self, root):
         self._roots.append(root)
+        # path elements are resolved against the roots.
+        self.invalidate()
 
     # Modular Config Infrastructure
+    #
+    # Each element is compiled into an accessor when it is registered,
+    # so that the spec is unpacked and the type dispatch is done once
+    # instead of on every read. Values returned by the accessors are
+    # cached in the instance __dict__, which lets subsequent reads bypass
+    # __getattr__ entirely. The cache is dropped whenever the underlying
+    # configuration may have changed, i.e. on writes, removals, element
+    # and application root registration, and reloads.
+    #
+    # Derived elements and callable fallbacks are cached as well, and
+    # should therefore depend only on other config elements. Anything
+    # else should call invalidate() when its inputs change.
+    _getters = {
+        str: 'get',
+        bool: 'getboolean',
+        int: 'getint',
+        float: 'getfloat',
+        'kivy_color': 'get',
+        'path': 'get',
+    }
+
     def register_element(self, name, element_spec):
         self._elements[name] = element_spec
+        self._accessors[name] = self._compile(element_spec)
+        self.invalidate()
 
-    def __getattr__(self, element):
-        if element not in self._elements.keys():
-            raise AttributeError(element)
-        section, item, item_spec = self._elements[element]
-        item_type, fallback, read_only, masked = item_spec
-        kwargs = {}
-        if callable(fallback):
-            fallback = fallback(self)
-        if not fallback == "_required":
-            kwargs['fallback'] = fallback
+    def _compile(self, element_spec):
+        section, item, item_spec = element_spec
         if section == '_derived':
-            return item(self)
-        if item_type == str:
-            return self._config.get(section, item, **kwargs)
-        elif item_type == bool:
-            return self._config.getboolean(section, item, **kwargs)
-        elif item_type == int:
-            return self._config.getint(section, item, **kwargs)
-        elif item_type == float:
-            return self._config.getfloat(section, item, **kwargs)
-        elif item_type == 'kivy_color':
-            return self._parse_color(self._config.get(section, item, **kwargs))
+            return item
+
+        item_type, fallback = item_spec.item_type, item_spec.fallback
+        getter = self._getters.get(item_type)
+        if getter is None:
+            return lambda config: None
+
+        if item_type == 'kivy_color':
+            convert = self._parse_color
         elif item_type == 'path':
-            return self.get_path(self._config.get(section, item, **kwargs))
+            convert = self.get_path
+        else:
+            convert = None
+
+        if callable(fallback):
+            def _read(config):
+                _fallback = fallback(config)
+                if _fallback == "_required":
+                    return getattr(config._config, getter)(section, item)
+                return getattr(config._config, getter)(section, item, fallback=_fallback)
+        elif fallback == "_required":
+            def _read(config):
+                return getattr(config._config, getter)(section, item)
+        else:
+            def _read(config):
+                return getattr(config._config, getter)(section, item, fallback=fallback)
+
+        if convert is None:
+            return _read
+        return lambda config: convert(_read(config))
+
+    def invalidate(self):
+        cached, self._cached = self._cached, set()
+        for element in cached:
+            self.__dict__.pop(element, None)
+
+    def reload(self, content=None):
+        # The new file is parsed completely before it replaces the current
+        # configuration. A file which fails to parse raises and leaves the
+        # current configuration untouched. Returns the elements with
+        # change callbacks whose values have changed.
+        config = ConfigParser()
+        if content is None:
+            config.read(self._config_file)
+        else:
+            config.read_string(content, source=self._config_file)
+        if self._dirty:
+            print("Discarding unsaved config changes on reload")
+            if self._write_call is not None and self._write_call.active():
+                self._write_call.cancel()
+            self._write_call = None
+            self._dirty = False
+
+        previous = {e: self._snapshot(e) for e in self._change_callbacks.keys()}
+        self._config = config
+        self.invalidate()
+        changed = []
+        for element, old_value in previous.items():
+            new_value = self._snapshot(element)
+            if new_value != old_value:
+                changed.append((element, old_value, new_value))
+        for element, old_value, new_value in changed:
+            for callback in self._change_callbacks[element]:
+                try:
+                    callback(element, old_value, new_value)
+                except Exception:
+                    print("Error in change callback for config element '{}'".format(element))
+                    traceback.print_exc()
+        return [x[0] for x in changed]
+
+    def _snapshot(self, element):
+        try:
+            return getattr(self, element)
+        except Exception:
+            return None
+
+    def register_change_callback(self, element, callback):
+        # callback(element, old_value, new_value) is called when a reload
+        # changes the value of the element.
+        self._change_callbacks.setdefault(element, []).append(callback)
+
+    def __getattr__(self, element):
+        try:
+            accessor = self.__dict__['_accessors'][element]
+        except KeyError:
+            raise AttributeError(element)
+        value = accessor(self)
+        self.__dict__[element] = value
+        self._cached.add(element)
+        return value
 
     def __setattr__(self, element, value):
         if element == '_elements' or element not in self._elements.keys():
@@ -178,19 +388,26 @@ class IoTNodeConfig(object):
         self._check_section(section)
         self._config.set(section, item, value)
         self._write_config()
+        self.invalidate()
 
     def remove(self, element):
         section, item, item_spec = self._elements[element]
         if item_spec.read_only:
             return False
         try:
-            return self._config.remove_option(section, item)
+            result = self._config.remove_option(section, item)
         except NoSectionError:
-            pass
+            return
+        self.invalidate()
+        if result:
+            self._write_config()
+        return result
 
     def _config_init(self):
         _elements = {
             'platform': ElementSpec('platform', 'platform', ItemSpec(fallback='native')),
+            'config_write_delay': ElementSpec('config', 'write_delay', ItemSpec(float, fallback=2.0)),
+            'config_hot_reload': ElementSpec('config', 'hot_reload', ItemSpec(bool, fallback=True)),
         }
 
         for element, element_spec in _elements.items():
@@ -226,3 +443,6 @@ class ConfigMixin(object):
 
     def config_register_element(self, name, element_spec):
         self.config.register_element(name, element_spec)
+
+    def config_register_change_callback(self, element, callback):
+        self.config.register_change_callback(element, callback)
@@ -0,0 +1,84 @@
+
+
+import os
+
+from twisted.python.filepath import FilePath
+
+from .nodelog import NodeLogger
+
+
+class ConfigWatcher(object):
+    # Watches the config file with inotify and hot reloads it when it is
+    # changed by something other than the node itself.
+    #
+    # The directory is watched rather than the file, since editors and
+    # the node's own atomic writes replace the file, which would orphan a
+    # watch on the old inode. Bursts of events are coalesced and handled
+    # debounce seconds after the last one.
+    def __init__(self, config, reactor, debounce=0.5):
+        self._config = config
+        self._reactor = reactor
+        self._log = None
+        self.debounce = debounce
+        self._notifier = None
+        self._pending = None
+
+    @property
+    def log(self):
+        if not self._log:
+            self._log = NodeLogger(namespace="config", source=self)
+        return self._log
+
+    @property
+    def path(self):
+        return self._config._config_file
+
+    def start(self):
+        if self._notifier is not None:
+            return
+        try:
+            from twisted.internet import inotify
+        except ImportError:
+            self.log.warn("inotify is not available. Config hot reload is disabled.")
+            return
+        mask = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+        self._notifier = inotify.INotify(self._reactor)
+        self._notifier.startReading()
+        self._notifier.watch(FilePath(os.path.dirname(self.path)),
+                             mask=mask, callbacks=[self._notify])
+        self.log.info("Watching {path} for changes", path=self.path)
+
+    def stop(self):
+        if self._pending is not None and self._pending.active():
+            self._pending.cancel()
+        self._pending = None
+        if self._notifier is not None:
+            self._notifier.loseConnection()
+        self._notifier = None
+
+    def _notify(self, _, filepath, mask):
+        if filepath.asTextMode().basename() != os.path.basename(self.path):
+            return
+        if self._pending is not None and self._pending.active():
+            self._pending.reset(self.debounce)
+        else:
+            self._pending = self._reactor.callLater(self.debounce, self._reload)
+
+    def _reload(self):
+        self._pending = None
+        try:
+            with open(self.path) as f:
+                content = f.read()
+        except OSError as e:
+            self.log.warn("Could not read {path} : {e}", path=self.path, e=e)
+            return
+        if content == self._config._last_written:
+            return
+        try:
+            changed = self._config.reload(content)
+        except Exception as e:
+            self.log.error("Not reloading {path}, it could not be parsed : {e}",
+                           path=self.path, e=e)
+            return
+        self.log.info("Reloaded {path}. Changed elements : {changed}",
+                      path=self.path, changed=changed or 'none')
@@ -0,0 +1,193 @@
+
+
+import os
+import zlib
+
+from zope.interface import implementer
+from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
+from twisted.internet.interfaces import IProtocol
+from twisted.web.iweb import IAgent
+from twisted.web.iweb import IResponse
+from twisted.web.iweb import UNKNOWN_LENGTH
+from twisted.web.client import ResponseDone
+from twisted.web.client import ResponseFailed
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from six.moves.urllib.parse import urlparse
+
+
+ACCEPT_ENCODING = b'gzip, deflate'
+IDENTITY = b'identity'
+
+# Media which is already compressed and gains nothing from a
+# content-encoding. Requests for these are always made uncompressed.
+COMPRESSED_EXTENSIONS = {
+    '.gz', '.tgz', '.bz2', '.xz', '.zst', '.zip', '.7z', '.rar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif', '.heic',
+    '.mp4', '.m4v', '.mkv', '.webm', '.mov', '.avi', '.ts', '.h264',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac',
+    '.woff', '.woff2', '.apk', '.deb', '.whl',
+}
+
+
+def should_compress(url, headers):
+    # Range requests are made against the identity encoding of the
+    # resource so that partial downloads can be resumed byte for byte.
+    if headers is not None and headers.hasHeader(b'range'):
+        return False
+    if isinstance(url, bytes):
+        url = url.decode()
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    return ext not in COMPRESSED_EXTENSIONS
+
+
+class CompressionStats(object):
+    def __init__(self):
+        self.responses = 0
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def record(self, wire_bytes, decoded_bytes):
+        self.responses += 1
+        self.wire_bytes += wire_bytes
+        self.decoded_bytes += decoded_bytes
+
+    @property
+    def ratio(self):
+        if not self.decoded_bytes:
+            return None
+        return self.wire_bytes / self.decoded_bytes
+
+    @property
+    def saved_bytes(self):
+        return self.decoded_bytes - self.wire_bytes
+
+    def as_dict(self):
+        return {
+            'responses': self.responses,
+            'wire_bytes': self.wire_bytes,
+            'decoded_bytes': self.decoded_bytes,
+            'ratio': self.ratio,
+        }
+
+
+class _DecodingProtocol(proxyForInterface(IProtocol)):
+    # Wraps the body collector, decompressing each chunk as it arrives.
+    # Only the current chunk is ever held in memory. wbits of 32 + 15
+    # auto-detects gzip and zlib framing. Raw deflate streams, which some
+    # servers send for 'deflate', are detected on the first chunk.
+    #
+    # A corrupt stream stops the transfer, and the wrapped protocol's
+    # connectionLost is then given a ResponseFailed carrying the decoding
+    # error, so that the request fails rather than hangs.
+    def __init__(self, protocol, response, stats=None):
+        self.original = protocol
+        self._response = response
+        self._stats = stats
+        self._decompress = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._started = False
+        self._failure = None
+        self.transport = None
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def makeConnection(self, transport):
+        self.transport = transport
+        self.original.makeConnection(transport)
+
+    def _deliver(self, data):
+        if data:
+            self.decoded_bytes += len(data)
+            self.original.dataReceived(data)
+
+    def dataReceived(self, data):
+        if self._failure is not None:
+            return
+        self.wire_bytes += len(data)
+        try:
+            try:
+                decoded = self._decompress.decompress(data)
+            except zlib.error:
+                if self._started:
+                    raise
+                self._decompress = zlib.decompressobj(-zlib.MAX_WBITS)
+                decoded = self._decompress.decompress(data)
+        except zlib.error:
+            self._failure = Failure()
+            if self.transport is not None:
+                self.transport.stopProducing()
+            return
+        self._started = True
+        self._deliver(decoded)
+
+    def connectionLost(self, reason):
+        if self._failure is None:
+            try:
+                self._deliver(self._decompress.flush())
+            except zlib.error:
+                self._failure = Failure()
+        if self._failure is not None:
+            self.original.connectionLost(Failure(
+                ResponseFailed([reason, self._failure], self._response)
+            ))
+            return
+        if self._stats is not None and \
+                reason.check(ResponseDone, PotentialDataLoss):
+            self._stats.record(self.wire_bytes, self.decoded_bytes)
+        self.original.connectionLost(reason)
+
+
+class DecodedResponse(proxyForInterface(IResponse)):
+    def __init__(self, response, stats=None):
+        self.original = response
+        self.length = UNKNOWN_LENGTH
+        self._stats = stats
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(
+            _DecodingProtocol(protocol, self.original, self._stats)
+        )
+
+
+@implementer(IAgent)
+class DecodingAgent(object):
+    # Agent wrapper which negotiates and transparently decodes gzip and
+    # deflate encoded responses.
+    #
+    # treq wraps every agent in a ContentDecoderAgent which always asks for
+    # gzip, including for range requests and already compressed media.
+    # This agent sits below it, closest to the wire, and has the final say
+    # on the Accept-Encoding header : compression is only requested when
+    # enabled and useful, and identity is requested otherwise. Since it
+    # also strips Content-Encoding from the responses it decodes, treq's
+    # own decoder is never engaged.
+    _decodable = (b'gzip', b'x-gzip', b'deflate')
+
+    def __init__(self, agent, stats=None, enabled=False):
+        self._agent = agent
+        self._stats = stats
+        self._enabled = enabled
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        if headers is None:
+            headers = Headers()
+        else:
+            headers = headers.copy()
+        if self._enabled and should_compress(uri, headers):
+            headers.setRawHeaders(b'accept-encoding', [ACCEPT_ENCODING])
+        else:
+            headers.setRawHeaders(b'accept-encoding', [IDENTITY])
+        d = self._agent.request(method, uri, headers, bodyProducer)
+        d.addCallback(self._handle_response)
+        return d
+
+    def _handle_response(self, response):
+        encodings = response.headers.getRawHeaders(b'content-encoding', [])
+        encodings = [x.strip().lower() for e in encodings for x in e.split(b',')]
+        encodings = [x for x in encodings if x and x != b'identity']
+        if len(encodings) != 1 or encodings[0] not in self._decodable:
+            return response
+        response.headers.removeHeader(b'content-encoding')
+        response.headers.removeHeader(b'content-length')
+        return DecodedResponse(response, self._stats)
@@ -0,0 +1,227 @@
+
+
+import random
+from six.moves.urllib.parse import urlparse
+from twisted.internet.defer import Deferred
+
+
+class HostUnavailableError(Exception):
+    def __init__(self, host, retry_in=None):
+        self.host = host
+        self.retry_in = retry_in
+
+    def __repr__(self):
+        return f"Host {self.host} unavailable, retry in {self.retry_in}s"
+
+
+CLOSED = 0
+OPEN = 1
+HALF_OPEN = 2
+
+
+def host_key(url):
+    if isinstance(url, bytes):
+        url = url.decode()
+    return urlparse(url).netloc or url
+
+
+class HostHealth(object):
+    # Circuit breaker state for a single host.
+    #
+    #  - closed    : Requests flow normally. Consecutive failures are
+    #                counted and the circuit opens once the threshold is
+    #                reached.
+    #  - open      : Requests are failed fast with HostUnavailableError.
+    #                A single timer, with an exponentially increasing and
+    #                jittered delay, moves the host to half-open.
+    #  - half-open : Exactly one request is allowed through as a probe.
+    #                Success closes the circuit and releases everyone
+    #                waiting on the host. Failure re-opens the circuit
+    #                with a longer delay.
+    def __init__(self, tracker, host):
+        self._tracker = tracker
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+        self.retry_at = None
+        self._reopen_call = None
+        self._waiters = []
+
+    @property
+    def reactor(self):
+        return self._tracker.reactor
+
+    @property
+    def retry_in(self):
+        if self.retry_at is None:
+            return None
+        return max(0, self.retry_at - self.reactor.seconds())
+
+    def allow(self):
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.trips = 0
+        self.probing = False
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        self.retry_at = None
+        self._cancel_reopen()
+        self._tracker.log.info("Host {host} recovered. Closing circuit.",
+                               host=self.host)
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == OPEN:
+            # Late failures from requests issued before the circuit opened.
+            return
+        if self.state == HALF_OPEN or \
+                self.failures >= self._tracker.threshold:
+            self._open()
+
+    def release(self):
+        # The request which was allowed through ended without telling us
+        # anything about the host, for example because it was cancelled or
+        # failed locally. If it was the probe, let the next request probe
+        # the host instead.
+        if not self.probing:
+            return
+        self.probing = False
+        if self.state == HALF_OPEN:
+            self._next_probe()
+
+    def _open(self):
+        self.trips += 1
+        self.state = OPEN
+        delay = self._tracker.backoff(self.trips)
+        self.retry_at = self.reactor.seconds() + delay
+        self._cancel_reopen()
+        self._reopen_call = self.reactor.callLater(delay, self._half_open)
+        self._tracker.log.warn(
+            "Host {host} unhealthy after {failures} failures. "
+            "Opening circuit for {delay:.1f}s.",
+            host=self.host, failures=self.failures, delay=delay
+        )
+
+    def _half_open(self):
+        self._reopen_call = None
+        self.state = HALF_OPEN
+        self.retry_at = None
+        self.probing = False
+        self._next_probe()
+
+    def _next_probe(self):
+        # Only one waiter gets to probe the host. The rest are released
+        # when the probe succeeds. Waiters which don't end up making a
+        # request pass the probe on to the next in line.
+        while self._waiters and self.state == HALF_OPEN and not self.probing:
+            self._waiters.pop(0).callback(None)
+
+    def _cancel_reopen(self):
+        if self._reopen_call and self._reopen_call.active():
+            self._reopen_call.cancel()
+        self._reopen_call = None
+
+    def wait(self):
+        def _canceller(d):
+            if d in self._waiters:
+                self._waiters.remove(d)
+        d = Deferred(canceller=_canceller)
+        self._waiters.append(d)
+        return d
+
+    def cancel(self):
+        self._cancel_reopen()
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.cancel()
+
+
+class HostHealthTracker(object):
+    def __init__(self, reactor, log, threshold=3,
+                 backoff_base=5, backoff_max=900):
+        self.reactor = reactor
+        self.log = log
+        self.threshold = threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._hosts = {}
+
+    def host(self, url):
+        key = host_key(url)
+        if key not in self._hosts:
+            self._hosts[key] = HostHealth(self, key)
+        return self._hosts[key]
+
+    def backoff(self, attempt, base=None):
+        # Exponential backoff with equal jitter. Half the window is fixed
+        # so that retries never collapse to zero delay, the other half is
+        # randomized to spread out retries from many callers.
+        if base is None:
+            base = self.backoff_base
+        window = min(self.backoff_max, base * (2 ** max(0, attempt - 1)))
+        return window / 2 + random.uniform(0, window / 2)
+
+    def allow(self, url):
+        return self.host(url).allow()
+
+    def check(self, url):
+        host = self.host(url)
+        if not host.allow():
+            raise HostUnavailableError(host.host, host.retry_in)
+
+    def success(self, url):
+        self.host(url).success()
+
+    def failure(self, url):
+        self.host(url).failure()
+
+    def release(self, url):
+        self.host(url).release()
+
+    def available(self, url):
+        return self.host(url).state == CLOSED
+
+    def wait(self, url, min_delay=0, attempt=1):
+        # Return a deferred which fires when it is reasonable to retry a
+        # request to the host of the given url.
+        #
+        #  - If the host circuit is open, the caller is queued behind the
+        #    single host probe instead of scheduling its own timer.
+        #  - Otherwise, the deferred fires after a jittered exponential
+        #    backoff based on min_delay and the attempt number.
+        host = self.host(url)
+        if host.state != CLOSED:
+            return host.wait()
+        delay = self.backoff(attempt, base=min_delay) if min_delay else 0
+
+        def _canceller(_):
+            if call.active():
+                call.cancel()
+        d = Deferred(canceller=_canceller)
+        call = self.reactor.callLater(delay, d.callback, None)
+        return d
+
+    def status(self):
+        return {
+            k: {'state': v.state, 'failures': v.failures,
+                'retry_in': v.retry_in, 'waiting': len(v._waiters)}
+            for k, v in self._hosts.items()
+        }
+
+    def stop(self):
+        for host in self._hosts.values():
+            host.cancel()
@@ -0,0 +1,35 @@
+
+
+from treq.client import HTTPClient
+
+
+class DefaultHeadersHttpClient(HTTPClient):
+    def __init__(self, *args, **kwargs):
+        self._default_headers = kwargs.pop('headers', {})
+        super(DefaultHeadersHttpClient, self).__init__(*args, **kwargs)
+
+    # Default headers are merged into a copy of the headers passed in, so
+    # the caller's dict is never modified.
+    def get(self, url, **kwargs):
+        simple_headers = dict(kwargs.pop('headers', None) or {})
+        simple_headers.update(self._default_headers)
+        kwargs['headers'] = simple_headers
+        return super(DefaultHeadersHttpClient, self).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        simple_headers = dict(kwargs.pop('headers', None) or {})
+        simple_headers.update(self._default_headers)
+        kwargs['headers'] = simple_headers
+        return super(DefaultHeadersHttpClient, self).post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        simple_headers = dict(kwargs.pop('headers', None) or {})
+        simple_headers.update(self._default_headers)
+        kwargs['headers'] = simple_headers
+        return super(DefaultHeadersHttpClient, self).put(url, **kwargs)
+
+    def head(self, url, **kwargs):
+        simple_headers = dict(kwargs.pop('headers', None) or {})
+        simple_headers.update(self._default_headers)
+        kwargs['headers'] = simple_headers
+        return super(DefaultHeadersHttpClient, self).head(url, **kwargs)
@@ -3,9 +3,11 @@
 import os
 import io
 import sys
-import time
-import zipfile
+import signal
+import atexit
 from twisted import logger
+from twisted.internet.threads import deferToThread
+from twisted.internet.defer import succeed
 from twisted.logger import LogLevel
 from twisted.logger import LogLevelFilterPredicate
 from twisted.logger import FilteringLogObserver
@@ -17,6 +19,17 @@ from datetime import datetime
 from .config import ElementSpec, ItemSpec
 from .config import ConfigMixin
 from .basemixin import BaseMixin
+from .logwriter import AsyncLogObserver
+from .logwriter import StreamLogSink
+from .logwriter import RotatingFileLogSink
+from .logwriter import compress_log
+from .logwriter import prune_logs
+from .logstore import JsonLogSink
+from .logstore import JsonLogStore
+from .logpackage import LogPackageBuilder
+from .logpackage import LogPackageProducer
+from .logbuffer import RingBufferObserver
+from .nodelog import NodeLogger
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -24,42 +37,116 @@ logging.basicConfig(level=logging.INFO)
 
 class NodeLoggingMixin(ConfigMixin, BaseMixin):
     _log = None
+    _log_dir = None
 
     def __init__(self, *args, **kwargs):
         super(NodeLoggingMixin, self).__init__(*args, **kwargs)
         self._log_file = None
-        self.log_prune()
-        self._log = logger.Logger(namespace=self.appname,
-                                  source=self)
+        self._log_file_day = None
+        self._log_writers = []
+        self._log_level_predicate = None
+        self._log_recent = None
+        self._log_store_sink = None
+        self._log = NodeLogger(namespace=self.appname, source=self)
         self.reactor.callWhenRunning(self._start_logging)
+        self.reactor.callWhenRunning(self.log_prune)
 
     def install(self):
         super(NodeLoggingMixin, self).install()
         _elements = {
             'debug': ElementSpec('debug', 'debug', ItemSpec(bool, fallback=False, read_only=False)),
+            'log_async': ElementSpec('log', 'async', ItemSpec(bool, fallback=True)),
+            'log_queue_size': ElementSpec('log', 'queue_size', ItemSpec(int, fallback=10000)),
+            'log_overflow_policy': ElementSpec('log', 'overflow_policy', ItemSpec(str, fallback='drop')),
+            'log_max_file_size': ElementSpec('log', 'max_file_size', ItemSpec(int, fallback=10000000)),
+            'log_max_total_size': ElementSpec('log', 'max_total_size', ItemSpec(int, fallback=200000000)),
+            'log_max_age': ElementSpec('log', 'max_age', ItemSpec(int, fallback=7)),
+            'log_compress': ElementSpec('log', 'compress', ItemSpec(bool, fallback=True)),
+            'log_structured': ElementSpec('log', 'structured', ItemSpec(bool, fallback=False)),
+            'log_structured_max_size': ElementSpec('log', 'structured_max_size', ItemSpec(int, fallback=50000000)),
+            'log_recent_size': ElementSpec('log', 'recent_size', ItemSpec(int, fallback=1000)),
         }
 
         for element, element_spec in _elements.items():
             self.config.register_element(element, element_spec)
+        self.config.register_change_callback('debug', self._log_level_changed)
 
-    def _observers(self):
+    @property
+    def log_level(self):
         if self.config.debug:
-            level = LogLevel.debug
+            return LogLevel.debug
+        return LogLevel.info
+
+    def _log_level_changed(self, element, old, new):
+        level = self.log_level
+        NodeLogger.set_level(level)
+        if self._log_level_predicate is not None:
+            self._log_level_predicate.setLogLevelForNamespace(None, level)
+        self.log.info("Log level changed to {level}", level=level.name)
+
+    def _observers(self):
+        level = self.log_level
+        # Events below the log level are dropped by NodeLoggers before they
+        # are built. The predicate filters events from other loggers.
+        NodeLogger.set_level(level)
+        self._log_level_predicate = LogLevelFilterPredicate(level)
+
+        if self.config.log_async:
+            # Formatting and writes happen in background threads. Level
+            # filtering is still done here, so that filtered events never
+            # reach the queues.
+            self._log_writers = [
+                AsyncLogObserver(StreamLogSink(sys.stdout),
+                                 max_queue=self.config.log_queue_size,
+                                 policy=self.config.log_overflow_policy,
+                                 name='log-writer-stdout'),
+                AsyncLogObserver(RotatingFileLogSink(lambda: self.log_file,
+                                                     max_bytes=self.config.log_max_file_size,
+                                                     on_rotate=self._log_rotated),
+                                 max_queue=self.config.log_queue_size,
+                                 policy=self.config.log_overflow_policy,
+                                 name='log-writer-file'),
+            ]
+            for writer in self._log_writers:
+                atexit.register(writer.stop)
+            stdout_observer, file_observer = self._log_writers
         else:
-            level = LogLevel.info
+            stdout_observer = textFileLogObserver(sys.stdout)
+            file_observer = textFileLogObserver(io.open(self.log_file, 'a'))
 
-        return [
+        observers = [
             # STDLibLogObserver(),
             FilteringLogObserver(
-                textFileLogObserver(sys.stdout),
+                stdout_observer,
                 predicates=[LogLevelFilterPredicate(LogLevel.warn)]
             ),
             FilteringLogObserver(
-                textFileLogObserver(io.open(self.log_file, 'a')),
-                predicates=[LogLevelFilterPredicate(level)]
+                file_observer,
+                predicates=[self._log_level_predicate]
             ),
         ]
 
+        if self.config.log_structured:
+            self._log_store_sink = JsonLogSink(self.log_store_dir)
+            store_writer = AsyncLogObserver(self._log_store_sink,
+                                            max_queue=self.config.log_queue_size,
+                                            policy=self.config.log_overflow_policy,
+                                            name='log-writer-store')
+            atexit.register(store_writer.stop)
+            self._log_writers.append(store_writer)
+            observers.append(FilteringLogObserver(
+                store_writer,
+                predicates=[self._log_level_predicate]
+            ))
+
+        if self.config.log_recent_size:
+            self._log_recent = RingBufferObserver(self.config.log_recent_size)
+            observers.append(FilteringLogObserver(
+                self._log_recent,
+                predicates=[self._log_level_predicate]
+            ))
+        return observers
+
     def _start_logging(self):
         # TODO Mention that docs don't say reactor should be running
         # TODO Mention that docs are confusing about how extract works
@@ -68,6 +155,62 @@ class NodeLoggingMixin(ConfigMixin, BaseMixin):
         # TODO log_source is not set when logger instantiated in __init__
         logger.globalLogBeginner.beginLoggingTo(self._observers())
         self.log.info("Logging to {logfile}", logfile=self.log_file)
+        if self._log_recent is not None:
+            self._log_install_dump_hooks()
+
+    def _log_install_dump_hooks(self):
+        # Recent events are written out on SIGUSR1, and when the process
+        # dies of an uncaught exception. The signal handler only hands the
+        # dump to the reactor, which does the file I/O.
+        if hasattr(signal, 'SIGUSR1'):
+            try:
+                signal.signal(signal.SIGUSR1,
+                              lambda signum, frame: self.reactor.callFromThread(
+                                  self.log_dump_recent))
+            except ValueError:
+                # Not on the main thread.
+                pass
+
+        previous_hook = sys.excepthook
+
+        def _excepthook(*args):
+            try:
+                self.log_dump_recent()
+            except Exception:
+                pass
+            previous_hook(*args)
+        sys.excepthook = _excepthook
+
+    def log_recent(self, level=None, namespace=None, since=None, limit=None):
+        # Recent events held in memory, oldest first, without any disk
+        # I/O. level is the minimum level and namespace also matches
+        # namespaces below it.
+        if self._log_recent is None:
+            return []
+        return self._log_recent.events(level=level, namespace=namespace,
+                                       since=since, limit=limit)
+
+    def log_dump_recent(self, path=None, **filters):
+        # Writes recent events to path, by default recent.log in the log
+        # directory, and returns the path.
+        if self._log_recent is None:
+            return None
+        if not path:
+            path = os.path.join(self.log_dir, 'recent.log')
+        with io.open(path, 'w') as f:
+            self._log_recent.dump(f, **filters)
+        return path
+
+    def log_flush(self, timeout=5):
+        for writer in self._log_writers:
+            writer.flush(timeout)
+
+    def stop(self):
+        super(NodeLoggingMixin, self).stop()
+        # The writers are only flushed and not stopped here, since mixins
+        # higher up in the MRO log after this returns. They are stopped,
+        # writing out anything still queued, at exit.
+        self.log_flush()
 
     @property
     def log(self):
@@ -75,19 +218,82 @@ class NodeLoggingMixin(ConfigMixin, BaseMixin):
 
     @property
     def log_file(self):
-        if not self._log_file:
-            self._log_file = os.path.join(
-                self.log_dir,
-                'runlog_{0}'.format(datetime.today().strftime('%d%m%y'))
-            )
+        # Log files are named by date. The name is recomputed when the date
+        # changes, and the file writer moves to the new file.
+        day = datetime.today().strftime('%d%m%y')
+        if day != self._log_file_day:
+            self._log_file = os.path.join(self.log_dir, 'runlog_{0}'.format(day))
+            self._log_file_day = day
         return self._log_file
 
+    def _log_rotated(self, path):
+        # Called from the log writer thread with each completed log file.
+        self.reactor.callFromThread(self._log_compress, path)
+
+    def _log_compress(self, path):
+        if self.config.log_compress:
+            d = deferToThread(compress_log, path)
+        else:
+            d = succeed(None)
+        d.addCallback(lambda _: self.log_prune())
+
+        def _failed(failure):
+            self.log.warn("Could not compress log file {path} : {e}",
+                          path=path, e=failure.value)
+        d.addErrback(_failed)
+        return d
+
     def log_prune(self):
-        for fname in self.log_files:
-            fpath = os.path.join(self.log_dir, fname)
-            mtime = os.path.getmtime(fpath)
-            if time.time() - mtime > (7 * 24 * 60 * 60):
-                os.remove(fpath)
+        # Enforces the age limit and the total size budget of the log
+        # directory, in a thread.
+        d = deferToThread(
+            prune_logs, self.log_dir,
+            max_total=self.config.log_max_total_size,
+            max_age=self.config.log_max_age * 24 * 60 * 60,
+            exclude=(self.log_file,),
+        )
+
+        def _prune_store(removed):
+            if not os.path.isdir(self.log_store_dir):
+                return removed
+            exclude = (self.log_file,)
+            if self._log_store_sink is not None:
+                exclude += self._log_store_sink.active_paths
+            return removed + prune_logs(
+                self.log_store_dir,
+                max_total=self.config.log_structured_max_size,
+                max_age=self.config.log_max_age * 24 * 60 * 60,
+                exclude=exclude,
+            )
+        if self.config.log_structured:
+            d.addCallback(lambda removed: deferToThread(_prune_store, removed))
+
+        def _pruned(removed):
+            if removed:
+                self.log.info("Pruned {n} log files", n=len(removed))
+            return removed
+        d.addCallback(_pruned)
+        return d
+
+    @property
+    def log_store_dir(self):
+        return os.path.join(self.log_dir, 'events')
+
+    @property
+    def log_store(self):
+        # Structured log store, populated when log_structured is enabled.
+        return JsonLogStore(self.log_store_dir)
+
+    def log_query(self, since=None, until=None, level=None, namespace=None, limit=None):
+        # Queries the structured log store in a thread. since and until
+        # are unix timestamps, level is the minimum level name, and
+        # namespace also matches namespaces below it. For example, errors
+        # from the resource manager in the last hour :
+        #
+        #   node.log_query(since=time.time() - 3600, level='error', namespace='rm')
+        return deferToThread(lambda: list(self.log_store.query(
+            since=since, until=until, level=level, namespace=namespace, limit=limit
+        )))
 
     @property
     def log_files(self):
@@ -100,23 +306,36 @@ class NodeLoggingMixin(ConfigMixin, BaseMixin):
 
     @property
     def log_dir(self):
-        os.makedirs(user_log_dir(self.appname), exist_ok=True)
-        return user_log_dir(self.appname)
+        if not self._log_dir:
+            self._log_dir = user_log_dir(self.appname)
+            os.makedirs(self._log_dir, exist_ok=True)
+        return self._log_dir
+
+    def log_package_builder(self, since=None, until=None, max_size=None, **filters):
+        store_dir = self.log_store_dir if self.config.log_structured else None
+        return LogPackageBuilder(self.log_dir, since=since, until=until,
+                                 max_size=max_size, store_dir=store_dir, **filters)
 
-    def log_build_package(self, out_path=None):
+    def log_build_package(self, out_path=None, since=None, until=None,
+                          max_size=None, **filters):
+        # Builds a zip of the logs in a thread. Returns a deferred which
+        # fires with the path of the package. since and until are unix
+        # timestamps, and max_size caps the size of the package. Any other
+        # filters are passed to log_query(), and restrict the package to
+        # the matching records of the structured log store.
         if not out_path:
             ctime = datetime.now().strftime("%Y%m%d%H%M%S")
             out_path = os.path.join('/tmp', f'{self.id}.{ctime}.logs.zip')
+        builder = self.log_package_builder(since=since, until=until,
+                                           max_size=max_size, **filters)
+        return deferToThread(builder.build, out_path)
 
-        with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for root, dirs, files in os.walk(self.log_dir):
-                for file_or_dir in files + dirs:
-                    zip_file.write(
-                        os.path.join(root, file_or_dir),
-                        os.path.relpath(os.path.join(root, file_or_dir), self.log_dir)
-                    )
-
-        return out_path
+    def log_package_producer(self, since=None, until=None, max_size=None, **filters):
+        # Body producer which streams the package as it is built, for
+        # uploading without a temporary file.
+        builder = self.log_package_builder(since=since, until=until,
+                                           max_size=max_size, **filters)
+        return LogPackageProducer(builder, self.reactor)
 
     def exim_install(self):
         super(NodeLoggingMixin, self).exim_install()
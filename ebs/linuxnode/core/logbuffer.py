@@ -0,0 +1,83 @@
+
+
+import heapq
+from collections import deque
+
+from zope.interface import implementer
+from twisted.logger import ILogObserver
+from twisted.logger import LogLevel
+from twisted.logger import formatEventAsClassicLogText
+
+
+_LEVELS = [LogLevel.debug, LogLevel.info, LogLevel.warn,
+           LogLevel.error, LogLevel.critical]
+
+
+@implementer(ILogObserver)
+class RingBufferObserver(object):
+    # Keeps the most recent log events in memory, for inspection without
+    # touching the disk.
+    #
+    # Each level has its own fixed size ring, so that a flood of debug or
+    # info events never pushes out the last few errors. Recording an event
+    # is a single deque append of a reference to the event, which is only
+    # formatted when it is read back. capacity maps level names to ring
+    # sizes, and a size of 0 keeps no events of that level.
+    #
+    # Appends are atomic, so events may be recorded from any thread.
+    # Events should not be mutated after being logged.
+    def __init__(self, capacity=1000):
+        if isinstance(capacity, int):
+            capacity = {level.name: capacity for level in _LEVELS}
+        self._rings = {}
+        for level in _LEVELS:
+            size = capacity.get(level.name, 0)
+            if size:
+                self._rings[level] = deque(maxlen=size)
+
+    def __call__(self, event):
+        ring = self._rings.get(event.get('log_level'))
+        if ring is not None:
+            ring.append(event)
+
+    def __len__(self):
+        return sum(len(x) for x in self._rings.values())
+
+    def clear(self):
+        for ring in self._rings.values():
+            ring.clear()
+
+    def events(self, level=None, namespace=None, since=None, limit=None):
+        # Returns the matching events, oldest first. level is the minimum
+        # level, and namespace also matches namespaces below it. limit
+        # keeps the newest events.
+        if isinstance(level, str):
+            level = LogLevel.levelWithName(level)
+        rings = [list(ring) for lvl, ring in self._rings.items()
+                 if level is None or lvl >= level]
+        events = heapq.merge(*rings, key=lambda e: e.get('log_time', 0))
+        selected = deque(maxlen=limit)
+        for event in events:
+            if since is not None and event.get('log_time', 0) < since:
+                continue
+            if namespace is not None:
+                ns = event.get('log_namespace') or ''
+                if ns != namespace and not ns.startswith(namespace + '.'):
+                    continue
+            selected.append(event)
+        return list(selected)
+
+    def dump(self, stream, **filters):
+        # Writes the matching events to stream as classic log text. Returns
+        # the number of events written.
+        n = 0
+        for event in self.events(**filters):
+            try:
+                text = formatEventAsClassicLogText(event)
+            except Exception:
+                continue
+            if text:
+                stream.write(text)
+                n += 1
+        stream.flush()
+        return n
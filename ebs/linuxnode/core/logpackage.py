@@ -0,0 +1,271 @@
+
+
+import os
+import json
+import shutil
+import zipfile
+import threading
+
+from zope.interface import implementer
+from twisted.internet.defer import Deferred
+from twisted.internet.threads import deferToThread
+from twisted.internet.threads import blockingCallFromThread
+from twisted.web.iweb import IBodyProducer
+from twisted.web.iweb import UNKNOWN_LENGTH
+
+from .encoding import COMPRESSED_EXTENSIONS
+from .logstore import JsonLogStore
+
+
+PACKAGE_CHUNK_SIZE = 65536
+
+# Bytes reserved for zip structures when enforcing max_size. Each entry
+# has a local header, a data descriptor and a central directory record,
+# each with zip64 extras, and the archive ends with the zip64 and classic
+# end of central directory records.
+_ENTRY_OVERHEAD = 30 + 20 + 24 + 46 + 28
+_END_OVERHEAD = 56 + 20 + 22
+
+# Files which are stored as is, rather than being compressed again.
+STORED_EXTENSIONS = COMPRESSED_EXTENSIONS | {'.gz', '.zip'}
+
+
+class LogPackageBuilder(object):
+    # Builds a zip of the log directory by streaming into any writable
+    # file-like object, which need not be seekable. Only one chunk of one
+    # file is held in memory at a time.
+    #
+    #  - Only files modified at or after since are included. The structured
+    #    log store, if present, is filtered by record time instead, using
+    #    since, until and any further query filters.
+    #  - Files are added newest first. Files which would take the package
+    #    over max_size bytes, assuming no compression, are skipped, so the
+    #    cap is never exceeded and the most recent logs are kept. The
+    #    extract of the structured store is written first, and is cut
+    #    short once it would exceed the cap. Space for the zip headers and
+    #    central directory is reserved along the way.
+    #  - Files which are already compressed are stored without
+    #    compression.
+    #  - If filters other than the time window are given, such as level
+    #    or namespace, they cannot be applied to text logs. The package
+    #    then contains only the filtered extract of the structured store.
+    def __init__(self, log_dir, since=None, until=None, max_size=None,
+                 store_dir=None, **filters):
+        self.log_dir = log_dir
+        self.since = since
+        self.until = until
+        self.max_size = max_size
+        self.store_dir = store_dir
+        self.filters = filters
+        self.included = []
+        self.skipped = []
+        self.truncated = False
+        self._reserved = _END_OVERHEAD
+
+    def _candidates(self):
+        candidates = []
+        for root, dirs, files in os.walk(self.log_dir):
+            if self.store_dir and os.path.abspath(root).startswith(
+                    os.path.abspath(self.store_dir)):
+                continue
+            for filename in files:
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if self.since is not None and st.st_mtime < self.since:
+                    continue
+                candidates.append((st.st_mtime, st.st_size, path))
+        return sorted(candidates, reverse=True)
+
+    @staticmethod
+    def _compression(path):
+        if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def write_to(self, fileobj):
+        written = _CountingWriter(fileobj)
+        with zipfile.ZipFile(written, 'w') as zf:
+            if self.store_dir and os.path.isdir(self.store_dir):
+                self._write_store(zf, written)
+            if self.filters:
+                return written.count
+            for mtime, size, path in self._candidates():
+                arcname = os.path.relpath(path, self.log_dir)
+                if self._compression(path) == zipfile.ZIP_DEFLATED:
+                    # Deflate can grow incompressible data very slightly.
+                    size += size // 1000 + 64
+                if self._remaining(written, arcname) < size:
+                    self.skipped.append(path)
+                    continue
+                self._reserve(arcname)
+                self._write_file(zf, path, arcname)
+                self.included.append(path)
+        return written.count
+
+    @staticmethod
+    def _entry_overhead(arcname):
+        # The name appears in both the local header and the central
+        # directory.
+        return _ENTRY_OVERHEAD + 2 * len(arcname.encode('utf-8'))
+
+    def _remaining(self, written, arcname):
+        # Bytes left for the data of a new entry.
+        if self.max_size is None:
+            return float('inf')
+        return self.max_size - written.count - self._reserved - \
+            self._entry_overhead(arcname)
+
+    def _reserve(self, arcname):
+        # The central directory record is written at the end, so its space
+        # stays reserved. The rest of the entry overhead is counted by the
+        # writer as it goes.
+        self._reserved += 46 + 28 + len(arcname.encode('utf-8'))
+
+    def _write_file(self, zf, path, arcname):
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = self._compression(path)
+        with open(path, 'rb') as src, zf.open(zinfo, 'w', force_zip64=True) as dst:
+            shutil.copyfileobj(src, dst, PACKAGE_CHUNK_SIZE)
+
+    def _write_store(self, zf, written):
+        # The compressed size is only known once the entry is closed, so the
+        # uncompressed size is held to the remaining budget instead.
+        store = JsonLogStore(self.store_dir)
+        arcname = 'events.jsonl'
+        budget = self._remaining(written, arcname) - 64
+        if budget <= 0:
+            self.truncated = True
+            return
+        self._reserve(arcname)
+        zinfo = zipfile.ZipInfo(arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        used = 0
+        with zf.open(zinfo, 'w', force_zip64=True) as dst:
+            for record in store.query(since=self.since, until=self.until,
+                                      **self.filters):
+                line = (json.dumps(record) + '\n').encode('utf-8')
+                used += len(line) + len(line) // 1000
+                if used > budget:
+                    self.truncated = True
+                    break
+                dst.write(line)
+
+    def build(self, out_path):
+        # Writes the package to out_path, atomically.
+        tmp_path = out_path + '.partial'
+        try:
+            with open(tmp_path, 'wb') as f:
+                self.write_to(f)
+            os.replace(tmp_path, out_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return out_path
+
+
+class _CountingWriter(object):
+    # Minimal unseekable file object for zipfile, which counts the bytes
+    # written through it.
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.count = 0
+
+    def write(self, data):
+        self._fileobj.write(data)
+        self.count += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.count
+
+    def seekable(self):
+        return False
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+class _ProducerAborted(Exception):
+    pass
+
+
+class _ConsumerWriter(object):
+    # File object used by the builder thread. Buffers writes into chunks
+    # and hands each one to the consumer on the reactor thread, waiting
+    # while the consumer has paused the producer.
+    def __init__(self, producer, reactor, consumer):
+        self._producer = producer
+        self._reactor = reactor
+        self._consumer = consumer
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._buffered += len(data)
+        if self._buffered >= PACKAGE_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._producer._resumed.wait()
+        if self._producer._stopped:
+            raise _ProducerAborted()
+        blockingCallFromThread(self._reactor, self._consumer.write, data)
+
+
+@implementer(IBodyProducer)
+class LogPackageProducer(object):
+    # Body producer which builds the package in a thread as it is sent.
+    # No temporary file is needed, and the length is unknown, so the
+    # request is sent with chunked transfer encoding.
+    length = UNKNOWN_LENGTH
+
+    def __init__(self, builder, reactor):
+        self._builder = builder
+        self._reactor = reactor
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._stopped = False
+
+    def startProducing(self, consumer):
+        writer = _ConsumerWriter(self, self._reactor, consumer)
+
+        def _build():
+            self._builder.write_to(writer)
+            writer.flush()
+
+        finished = Deferred()
+        d = deferToThread(_build)
+
+        def _done(result):
+            if self._stopped:
+                # The request has already given up on the body.
+                return
+            finished.callback(None)
+
+        def _failed(failure):
+            if self._stopped:
+                return
+            finished.errback(failure)
+        d.addCallbacks(_done, _failed)
+        return finished
+
+    def pauseProducing(self):
+        self._resumed.clear()
+
+    def resumeProducing(self):
+        self._resumed.set()
+
+    def stopProducing(self):
+        self._stopped = True
+        self._resumed.set()
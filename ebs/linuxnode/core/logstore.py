@@ -0,0 +1,253 @@
+
+
+import os
+import json
+import time
+import struct
+
+from twisted.logger import LogLevel
+from twisted.logger import formatEvent
+
+from .logwriter import LogSink
+
+# Structured log store.
+#
+# Events are written as JSON lines to segment files named by the time of
+# their first event, events_<ms>.jsonl. A new segment is started once the
+# current one exceeds segment_size bytes.
+#
+# Each segment has a sidecar index, events_<ms>.idx, with one fixed size
+# record for every block of about index_block bytes of the segment :
+#
+#   <offset : u64> <length : u32> <first time : f64> <last time : f64>
+#   <level mask : u8>
+#
+# Blocks always end on a line boundary. A query reads only the blocks
+# whose time range and levels can match, followed by whatever was written
+# after the last complete block.
+
+_INDEX_RECORD = struct.Struct('<QIddB')
+_LEVELS = [LogLevel.debug, LogLevel.info, LogLevel.warn,
+           LogLevel.error, LogLevel.critical]
+_LEVEL_BITS = {level.name: 1 << idx for idx, level in enumerate(_LEVELS)}
+
+
+def level_mask(minimum=None):
+    # Mask of all levels at or above minimum.
+    if minimum is None:
+        return 0xff
+    if isinstance(minimum, LogLevel):
+        minimum = minimum.name
+    bit = _LEVEL_BITS[minimum]
+    return 0xff & ~(bit - 1)
+
+
+def event_as_record(event):
+    level = event.get('log_level')
+    record = {
+        't': event.get('log_time', time.time()),
+        'level': level.name if level is not None else 'info',
+        'ns': event.get('log_namespace'),
+        'msg': formatEvent(event),
+    }
+    failure = event.get('log_failure')
+    if failure is not None:
+        try:
+            record['failure'] = failure.getTraceback()
+        except Exception:
+            record['failure'] = repr(failure)
+    return record
+
+
+def _segment_start(filename):
+    try:
+        return int(filename[len('events_'):-len('.jsonl')]) / 1000
+    except ValueError:
+        return None
+
+
+class JsonLogSink(LogSink):
+    def __init__(self, directory, segment_size=10000000, index_block=65536):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.index_block = index_block
+        self._segment = None
+        self._index = None
+        self._offset = 0
+        self._reset_block()
+
+    def _reset_block(self):
+        self._block_start = self._offset
+        self._block_first = None
+        self._block_last = None
+        self._block_mask = 0
+
+    def _open(self, t):
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, 'events_{0}'.format(int(t * 1000)))
+        self._segment = open(base + '.jsonl', 'ab')
+        self._index = open(base + '.idx', 'ab')
+        self._offset = self._segment.tell()
+        self._reset_block()
+
+    def _close_block(self):
+        if self._block_first is None:
+            return
+        self._index.write(_INDEX_RECORD.pack(
+            self._block_start, self._offset - self._block_start,
+            self._block_first, self._block_last, self._block_mask
+        ))
+        self._reset_block()
+
+    def write_events(self, events, formatter):
+        lines = []
+        for event in events:
+            try:
+                record = event_as_record(event)
+                line = (json.dumps(record, default=repr) + '\n').encode('utf-8')
+            except Exception:
+                continue
+            if self._segment is None or self._offset >= self.segment_size:
+                if lines:
+                    self._segment.write(b''.join(lines))
+                    lines = []
+                self.close()
+                self._open(record['t'])
+            if self._block_first is None:
+                self._block_first = record['t']
+            self._block_last = max(record['t'], self._block_last or record['t'])
+            self._block_mask |= _LEVEL_BITS.get(record['level'], 0)
+            lines.append(line)
+            self._offset += len(line)
+            if self._offset - self._block_start >= self.index_block:
+                self._segment.write(b''.join(lines))
+                lines = []
+                self._close_block()
+        if lines:
+            self._segment.write(b''.join(lines))
+        return len(events)
+
+    @property
+    def active_paths(self):
+        # The segment and index currently being written, if any.
+        segment, index = self._segment, self._index
+        if segment is None or index is None:
+            return ()
+        return (segment.name, index.name)
+
+    def flush(self):
+        if self._segment is not None:
+            self._segment.flush()
+            self._index.flush()
+
+    def close(self):
+        if self._segment is None:
+            return
+        self._close_block()
+        self._segment.close()
+        self._index.close()
+        self._segment = None
+        self._index = None
+
+
+class JsonLogStore(object):
+    # Read side of the structured log store. Safe to use while a
+    # JsonLogSink is writing to the same directory, from any thread.
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        segments = []
+        for filename in os.listdir(self.directory):
+            if not filename.startswith('events_') or not filename.endswith('.jsonl'):
+                continue
+            start = _segment_start(filename)
+            if start is not None:
+                segments.append((start, os.path.join(self.directory, filename)))
+        return sorted(segments)
+
+    def _blocks(self, path, since, until, mask):
+        # Yields (offset, length) of the regions of the segment which need
+        # to be read. length is None for the unindexed tail.
+        index_path = path[:-len('.jsonl')] + '.idx'
+        try:
+            with open(index_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+        indexed_end = 0
+        usable = len(data) - len(data) % _INDEX_RECORD.size
+        for pos in range(0, usable, _INDEX_RECORD.size):
+            offset, length, first, last, levels = _INDEX_RECORD.unpack_from(data, pos)
+            indexed_end = offset + length
+            if since is not None and last < since:
+                continue
+            if until is not None and first > until:
+                continue
+            if not levels & mask:
+                continue
+            yield offset, length
+        yield indexed_end, None
+
+    def query(self, since=None, until=None, level=None, namespace=None, limit=None):
+        # Yields event records, oldest first. level is the minimum level,
+        # and namespace matches the namespace and any below it.
+        mask = level_mask(level)
+        segments = self.segments()
+        count = 0
+        for idx, (start, path) in enumerate(segments):
+            if until is not None and start > until:
+                break
+            if since is not None and idx + 1 < len(segments) and \
+                    segments[idx + 1][0] <= since:
+                continue
+            for record in self._query_segment(path, since, until, mask, namespace):
+                yield record
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    def _query_segment(self, path, since, until, mask, namespace):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return
+        with f:
+            for offset, length in self._blocks(path, since, until, mask):
+                f.seek(offset)
+                data = f.read() if length is None else f.read(length)
+                for line in data.splitlines():
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A line still being written.
+                        continue
+                    if self._match(record, since, until, mask, namespace):
+                        yield record
+
+    @staticmethod
+    def _match(record, since, until, mask, namespace):
+        t = record.get('t', 0)
+        if since is not None and t < since:
+            return False
+        if until is not None and t > until:
+            return False
+        if not _LEVEL_BITS.get(record.get('level'), 0xff) & mask:
+            return False
+        if namespace is not None:
+            ns = record.get('ns') or ''
+            if ns != namespace and not ns.startswith(namespace + '.'):
+                return False
+        return True
+
+    def extract(self, path, **kwargs):
+        # Writes the matching records to path as JSON lines. Returns the
+        # number of records written.
+        n = 0
+        with open(path, 'w') as f:
+            for record in self.query(**kwargs):
+                f.write(json.dumps(record) + '\n')
+                n += 1
+        return n
@@ -0,0 +1,324 @@
+
+
+import io
+import os
+import time
+import gzip
+import queue
+import shutil
+import threading
+
+from zope.interface import implementer
+from twisted.logger import ILogObserver
+from twisted.logger import LogLevel
+from twisted.logger import formatEventAsClassicLogText
+
+
+LOG_POLICY_DROP = 'drop'
+LOG_POLICY_BLOCK = 'block'
+
+
+class LogSink(object):
+    # Destination for formatted log text. Only ever used from the writer
+    # thread of a single AsyncLogObserver.
+    #
+    # The writer hands each batch of events to write_events(), which by
+    # default formats them with the observer's formatter and writes the
+    # result with a single call to write(). Sinks which need more than
+    # the formatted text can override write_events() instead.
+    def write_events(self, events, formatter):
+        lines = [x for x in (formatter(e) for e in events) if x]
+        if lines:
+            self.write(''.join(lines))
+        return len(lines)
+
+    def write(self, text):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamLogSink(LogSink):
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, text):
+        self._stream.write(text)
+
+    def flush(self):
+        self._stream.flush()
+
+
+class FileLogSink(LogSink):
+    def __init__(self, path, buffering=65536):
+        self.path = path
+        self._buffering = buffering
+        self._file = None
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = io.open(self.path, 'a', buffering=self._buffering)
+        return self._file
+
+    def write(self, text):
+        self.file.write(text)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        self._file = None
+
+
+class RotatingFileLogSink(FileLogSink):
+    # File sink which starts a new file when the current one would exceed
+    # max_bytes, or when path_factory returns a different path, as it does
+    # for date based log file names when the date changes.
+    #
+    # Files rotated for size are renamed to <path>.<n>, with n increasing.
+    # on_rotate is called with the path of each file which is complete,
+    # from the writer thread, and should hand off any work it needs to do.
+    # Sizes are counted in characters, which is exact for ASCII logs and
+    # close enough otherwise.
+    def __init__(self, path_factory, max_bytes=None, on_rotate=None,
+                 buffering=65536):
+        self._path_factory = path_factory
+        self.max_bytes = max_bytes
+        self._on_rotate = on_rotate
+        self._size = None
+        super(RotatingFileLogSink, self).__init__(path_factory(), buffering=buffering)
+
+    @property
+    def file(self):
+        if self._file is None:
+            self._file = io.open(self.path, 'a', buffering=self._buffering)
+            self._size = self._file.tell()
+        return self._file
+
+    def _complete(self, path):
+        if self._on_rotate is not None:
+            self._on_rotate(path)
+
+    def write(self, text):
+        path = self._path_factory()
+        if path != self.path:
+            self.close()
+            if os.path.exists(self.path):
+                self._complete(self.path)
+            self.path = path
+        f = self.file
+        if self.max_bytes and self._size and \
+                self._size + len(text) > self.max_bytes:
+            self.close()
+            rotated = next_rotation_path(self.path)
+            os.rename(self.path, rotated)
+            self._complete(rotated)
+            f = self.file
+        f.write(text)
+        self._size += len(text)
+
+
+def next_rotation_path(path):
+    directory, base = os.path.split(path)
+    prefix = base + '.'
+    indices = [0]
+    for filename in os.listdir(directory or '.'):
+        if not filename.startswith(prefix):
+            continue
+        index = filename[len(prefix):].split('.')[0]
+        if index.isdigit():
+            indices.append(int(index))
+    return '{0}.{1}'.format(path, max(indices) + 1)
+
+
+def compress_log(path):
+    # gzip a completed log file, replacing it. The compressed file is
+    # written under a temporary name first, so that an interruption never
+    # leaves a truncated .gz behind.
+    if path.endswith('.gz') or not os.path.exists(path):
+        return None
+    target = path + '.gz'
+    tmp_path = target + '.tmp'
+    with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 65536)
+    os.replace(tmp_path, target)
+    os.utime(target, (os.path.getatime(path), os.path.getmtime(path)))
+    os.remove(path)
+    return target
+
+
+def prune_logs(directory, max_total=None, max_age=None, exclude=()):
+    # Removes log files older than max_age seconds, then the oldest
+    # remaining files until the directory fits in max_total bytes. Files
+    # in exclude, such as the file currently being written, are counted
+    # but never removed. Returns the removed paths.
+    now = time.time()
+    files = []
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if os.path.isfile(path):
+            files.append((st.st_mtime, st.st_size, path))
+    files.sort()
+
+    removed = []
+    total = sum(x[1] for x in files)
+    for mtime, size, path in files:
+        if path in exclude:
+            continue
+        expired = max_age is not None and now - mtime > max_age
+        over = max_total is not None and total > max_total
+        if not (expired or over):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(path)
+    return removed
+
+
+class _Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+_STOP = object()
+
+
+@implementer(ILogObserver)
+class AsyncLogObserver(object):
+    # Log observer which hands events off to a background thread for
+    # formatting and writing, keeping log I/O off the reactor thread.
+    #
+    #  - Events are held in a queue of at most max_queue events.
+    #  - When the queue is full, the 'drop' policy discards the event and
+    #    counts it. The count is written to the log once there is room
+    #    again. The 'block' policy makes the caller wait for the writer
+    #    instead, which never loses events but can stall the reactor.
+    #  - The writer drains up to batch_size events at a time and writes
+    #    them with a single call to the sink. The sink is flushed whenever
+    #    the queue runs empty, and on flush().
+    #
+    # Events are shallow copied when they are queued. Objects referenced
+    # by the event are formatted later in the writer thread, and should
+    # not be mutated after being logged.
+    def __init__(self, sink, formatter=formatEventAsClassicLogText,
+                 max_queue=10000, policy=LOG_POLICY_DROP, batch_size=256,
+                 name='log-writer'):
+        if policy not in (LOG_POLICY_DROP, LOG_POLICY_BLOCK):
+            raise ValueError("Unknown log overflow policy '{0}'".format(policy))
+        self.sink = sink
+        self.formatter = formatter
+        self.policy = policy
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.written = 0
+        self._reported_dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def __call__(self, event):
+        event = dict(event)
+        if self.policy == LOG_POLICY_BLOCK:
+            self._queue.put(event)
+            return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    @property
+    def running(self):
+        return self._thread.is_alive()
+
+    def _format(self, event):
+        try:
+            return self.formatter(event)
+        except Exception:
+            return None
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            while len(items) < self.batch_size:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = []
+            flushes = []
+            stop = False
+            for item in items:
+                if item is _STOP:
+                    stop = True
+                elif isinstance(item, _Flush):
+                    flushes.append(item)
+                else:
+                    events.append(item)
+
+            dropped = self.dropped
+            if dropped > self._reported_dropped:
+                events.append({
+                    'log_format': "Log writer dropped {dropped} events under load",
+                    'dropped': dropped - self._reported_dropped,
+                    'log_level': LogLevel.warn,
+                    'log_namespace': 'logwriter',
+                    'log_time': time.time(),
+                })
+                self._reported_dropped = dropped
+
+            try:
+                if events:
+                    self.written += self.sink.write_events(events, self._format)
+                if flushes or stop or self._queue.empty():
+                    self.sink.flush()
+            except Exception:
+                # There is nowhere left to report this. Keep draining the
+                # queue so that producers are never blocked forever.
+                pass
+
+            for flush in flushes:
+                flush.done.set()
+            if stop:
+                break
+        self.sink.close()
+
+    def flush(self, timeout=5):
+        # Blocks until all events queued before the call have been written
+        # and the sink has been flushed, or until timeout.
+        if not self.running:
+            return False
+        marker = _Flush()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.done.wait(timeout)
+
+    def stop(self, timeout=5):
+        if not self.running:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
@@ -0,0 +1,86 @@
+
+
+from .hosthealth import host_key
+
+
+class MirrorStats(object):
+    def __init__(self):
+        self.throughput = None
+        self.latency = None
+        self.failures = 0
+        self.last_failure = None
+
+
+class MirrorRanker(object):
+    # Remembers how well each mirror host has performed and orders
+    # candidate URLs accordingly.
+    #
+    #  - Mirrors with no download history are tried first, ordered by
+    #    their probe latency, so that every mirror gets measured once.
+    #  - Mirrors with history are ordered by an exponentially weighted
+    #    moving average of observed download throughput.
+    #  - Mirrors which have failed within failure_penalty seconds are moved
+    #    to the end of the list.
+    def __init__(self, reactor, alpha=0.3, failure_penalty=300):
+        self._reactor = reactor
+        self.alpha = alpha
+        self.failure_penalty = failure_penalty
+        self._stats = {}
+
+    def stats(self, url):
+        key = host_key(url)
+        if key not in self._stats:
+            self._stats[key] = MirrorStats()
+        return self._stats[key]
+
+    def record_success(self, url, nbytes, elapsed):
+        stats = self.stats(url)
+        stats.failures = 0
+        if nbytes <= 0 or elapsed <= 0:
+            return
+        throughput = nbytes / elapsed
+        if stats.throughput is None:
+            stats.throughput = throughput
+        else:
+            stats.throughput = self.alpha * throughput + \
+                               (1 - self.alpha) * stats.throughput
+
+    def record_failure(self, url):
+        stats = self.stats(url)
+        stats.failures += 1
+        stats.last_failure = self._reactor.seconds()
+
+    def record_latency(self, url, latency):
+        stats = self.stats(url)
+        if stats.latency is None:
+            stats.latency = latency
+        else:
+            stats.latency = self.alpha * latency + (1 - self.alpha) * stats.latency
+
+    def needs_probe(self, url):
+        stats = self.stats(url)
+        return stats.throughput is None and stats.latency is None
+
+    def _recently_failed(self, stats):
+        if not stats.last_failure:
+            return False
+        return self._reactor.seconds() - stats.last_failure < self.failure_penalty
+
+    def rank(self, urls):
+        def _key(item):
+            idx, url = item
+            stats = self.stats(url)
+            if stats.throughput is None:
+                latency = stats.latency if stats.latency is not None else float('inf')
+                group, score = 0, latency
+            else:
+                group, score = 1, -stats.throughput
+            return self._recently_failed(stats), group, score, idx
+        return [url for _, url in sorted(enumerate(urls), key=_key)]
+
+    def status(self):
+        return {
+            k: {'throughput': v.throughput, 'latency': v.latency,
+                'failures': v.failures}
+            for k, v in self._stats.items()
+        }
@@ -1,11 +1,11 @@
 
 
 import uuid
-import netifaces
 
 from .basemixin import BaseMixin
 from .config import ConfigMixin
 from .config import ElementSpec, ItemSpec
+from .boot import boot_tracer
 
 
 class NodeIDMixin(ConfigMixin, BaseMixin):
@@ -31,6 +31,7 @@ class NodeIDMixin(ConfigMixin, BaseMixin):
             self._id = self._get_id()
         return self._id
 
+    @boot_tracer.traced('node_id')
     def _get_id(self):
         if self.config.node_id_override is not None:
             return self.config.node_id_override
@@ -45,6 +46,7 @@ class NodeIDMixin(ConfigMixin, BaseMixin):
         return hex(node_id)[2:]
 
     def _get_node_id_netifaces_guess(self):
+        import netifaces
         fallback_interfaces = self._node_id_netifaces_fallback_interfaces
         available_interfaces = netifaces.interfaces()
         default_gateway = netifaces.gateways()['default']
@@ -55,6 +57,7 @@ class NodeIDMixin(ConfigMixin, BaseMixin):
                 return iface
 
     def _get_node_id_netifaces(self, **kwargs):
+        import netifaces
         interface = kwargs.get('interface', None)
         if interface is None:
             interface = self._get_node_id_netifaces_guess()
@@ -0,0 +1,92 @@
+
+
+import time
+import threading
+
+from twisted.logger import Logger
+from twisted.logger import LogLevel
+
+
+class lazy(object):
+    # Log argument which is only computed if the event is actually
+    # formatted. Use it for arguments which are expensive to build :
+    #
+    #   self.log.debug("Request with {kwargs}", kwargs=lazy(self._sanitize, kwargs))
+    #
+    # Events are formatted by the log writers, possibly in another thread,
+    # so func should not depend on state which changes after the call.
+    def __init__(self, func, *args, **kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+
+    @property
+    def value(self):
+        if self._func is not None:
+            self._value = self._func(*self._args, **self._kwargs)
+            self._func = self._args = self._kwargs = None
+        return self._value
+
+    def __format__(self, spec):
+        return format(self.value, spec)
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class NodeLogger(Logger):
+    # Logger which drops events below the node's log level before they are
+    # built, and which can throttle repetitive messages.
+    #
+    #  - The level is shared by all NodeLoggers, and is set by
+    #    NodeLoggingMixin from the debug configuration. Until logging
+    #    starts, nothing is dropped. Use enabled() to skip preparing
+    #    arguments for a block of disabled log calls, and lazy() for
+    #    single expensive arguments.
+    #  - Passing log_throttle=<seconds> to any log call emits that message
+    #    at most once per interval. Messages are grouped by their format
+    #    string, or by log_throttle_key if given. The number of messages
+    #    suppressed in the meantime is reported with the next one emitted.
+    level = LogLevel.debug
+
+    _throttle_lock = threading.Lock()
+    _throttle_state = {}
+
+    @classmethod
+    def set_level(cls, level):
+        NodeLogger.level = level
+
+    def enabled(self, level):
+        return level >= NodeLogger.level
+
+    def _throttled(self, key, interval):
+        # Returns None if the message should be suppressed, otherwise the
+        # number of messages suppressed since the last one emitted.
+        now = time.monotonic()
+        key = (self.namespace, key)
+        with self._throttle_lock:
+            state = self._throttle_state.get(key)
+            if state is not None and now - state[0] < interval:
+                state[1] += 1
+                return None
+            suppressed = state[1] if state is not None else 0
+            self._throttle_state[key] = [now, 0]
+        return suppressed
+
+    def emit(self, level, format=None, **kwargs):
+        if level < NodeLogger.level:
+            return
+        interval = kwargs.pop('log_throttle', None)
+        key = kwargs.pop('log_throttle_key', format)
+        if interval is not None:
+            suppressed = self._throttled(key, interval)
+            if suppressed is None:
+                return
+            if suppressed:
+                kwargs['log_suppressed'] = suppressed
+                format = (format or '') + \
+                    " [{log_suppressed} similar messages suppressed]"
+        super(NodeLogger, self).emit(level, format, **kwargs)
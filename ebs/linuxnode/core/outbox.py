@@ -0,0 +1,430 @@
+
+
+import os
+import json
+import time
+
+from twisted.internet.task import LoopingCall
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import DeferredLock
+from twisted.internet.defer import CancelledError
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import Float
+from sqlalchemy import Text
+from sqlalchemy import func
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from .nodelog import NodeLogger
+from .http import HTTPError
+from .http import _http_errors
+
+Base = declarative_base()
+metadata = Base.metadata
+
+
+class OutboxModel(Base):
+    __tablename__ = 'outbox'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(Text, index=True)
+    payload = Column(Text)
+    created = Column(Float)
+
+
+class HttpOutbox(object):
+    # Durable queue of outbound POST payloads.
+    #
+    #  - Payloads are persisted to SQLite in batches, within commit_delay
+    #    seconds of being enqueued and on stop(), and are only removed
+    #    once the server has accepted the batch containing them. Delivery
+    #    is therefore at-least-once. Receivers should be prepared to see
+    #    the same payload more than once.
+    #  - Payloads queued for the same URL are coalesced into a single POST
+    #    whose JSON body is the list of payloads, up to batch_size at a time.
+    #  - The queue is bounded by both entry count and total payload size.
+    #    When either bound is exceeded, the oldest entries are dropped.
+    #  - Failed flushes are retried using the node's host health tracker,
+    #    so draining backs off while the host is down and resumes as soon
+    #    as it recovers.
+    def __init__(self, node, batch_size=100, flush_interval=60,
+                 max_entries=20000, max_size=5000000, commit_delay=1.0):
+        self._node = node
+        self._log = None
+        self._db = None
+        self._db_engine = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.commit_delay = commit_delay
+        self._buffer = []
+        self._write_call = None
+        self._writing = None
+        self._db_lock = DeferredLock()
+        self._loaded = False
+        self._load_waiters = []
+        self._url_pending = {}
+        self._count = 0
+        self._size = 0
+        self._batch_sizes = {}
+        self._flushing = {}
+        self._attempts = {}
+        self._flush_call = None
+        self._loop = None
+
+    @property
+    def node(self):
+        return self._node
+
+    @property
+    def log(self):
+        if not self._log:
+            self._log = NodeLogger(namespace="outbox", source=self)
+        return self._log
+
+    def enqueue(self, url, payload):
+        # Queued payloads are buffered in memory and written to the
+        # database in batches from a thread, at most commit_delay seconds
+        # later. Bounds are enforced against running totals, so enqueue
+        # itself never touches the database.
+        data = json.dumps(payload)
+        self._buffer.append((url, data, time.time()))
+        self._add_totals([(url, 1, len(data))])
+        if len(self._buffer) >= self.batch_size:
+            self._write_buffer()
+        elif self._write_call is None:
+            self._write_call = self.node.reactor.callLater(
+                self.commit_delay, self._write_buffer
+            )
+
+    # Database Access
+    #
+    # All database work runs in a thread, one operation at a time, so that
+    # the reactor never waits on the disk. The running totals of what is
+    # already in the database are loaded before the first operation. Until
+    # then, they only cover payloads enqueued since the outbox was created.
+    def _db_call(self, f, *args):
+        d = self._load_totals()
+        d.addCallback(lambda _: self._db_lock.run(deferToThread, f, *args))
+        return d
+
+    def _load_totals(self):
+        # Fires once the totals have been loaded.
+        d = Deferred()
+        if self._loaded:
+            d.callback(None)
+            return d
+        self._load_waiters.append(d)
+        if len(self._load_waiters) == 1:
+            ld = self._db_lock.run(deferToThread, self._read_totals)
+            ld.addBoth(self._totals_loaded)
+        return d
+
+    def _totals_loaded(self, result):
+        waiters, self._load_waiters = self._load_waiters, []
+        if isinstance(result, Failure):
+            for waiter in waiters:
+                waiter.errback(result)
+            return
+        self._loaded = True
+        # Nothing has been written or removed yet, so the database totals
+        # simply add to what has been enqueued so far.
+        self._add_totals(result)
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def _read_totals(self):
+        session = self.db()
+        try:
+            return self._query_totals(session)
+        finally:
+            session.close()
+
+    @staticmethod
+    def _query_totals(session):
+        return session.query(
+            OutboxModel.url, func.count(OutboxModel.id),
+            func.sum(func.length(OutboxModel.payload))
+        ).group_by(OutboxModel.url).all()
+
+    def _add_totals(self, totals):
+        for url, count, size in totals:
+            self._url_pending[url] = self._url_pending.get(url, 0) + count
+            self._count += count
+            self._size += size or 0
+
+    def _set_totals(self, totals):
+        self._url_pending = {}
+        self._count = 0
+        self._size = 0
+        self._add_totals(totals)
+        # Entries still in the buffer are not in the database yet.
+        self._add_totals([(url, 1, len(data)) for url, data, created in self._buffer])
+
+    @property
+    def _over_bounds(self):
+        return self._count > self.max_entries or self._size > self.max_size
+
+    def _write_buffer(self):
+        if self._write_call is not None and self._write_call.active():
+            self._write_call.cancel()
+        self._write_call = None
+        if self._writing is not None or not self._buffer:
+            return self._writing
+        rows, self._buffer = self._buffer, []
+        # Bounds are checked once the totals are known.
+        self._writing = self._load_totals()
+        self._writing.addCallback(lambda _: self._db_lock.run(
+            deferToThread, self._write_rows, rows, self._over_bounds
+        ))
+
+        def _written(result):
+            self._writing = None
+            dropped, totals = result
+            if totals is not None:
+                self._set_totals(totals)
+            if dropped:
+                self.log.warn("Outbox full. Dropped {n} oldest entries.", n=dropped)
+            if any(x >= self.batch_size for x in self._url_pending.values()):
+                self._schedule_flush()
+
+        def _failed(failure):
+            self._writing = None
+            # Put the rows back, to be written with the next batch.
+            self._buffer[:0] = rows
+            self.log.failure("Could not write queued payloads", failure=failure)
+        self._writing.addCallbacks(_written, _failed)
+        self._writing.addCallback(lambda _: self._buffer and self._write_later())
+        return self._writing
+
+    def _write_later(self):
+        if self._write_call is None:
+            self._write_call = self.node.reactor.callLater(
+                self.commit_delay, self._write_buffer
+            )
+
+    def _write_rows(self, rows, enforce):
+        # Runs in a thread. Returns the number of entries dropped to stay
+        # within bounds, and the recomputed totals if any were.
+        session = self.db()
+        try:
+            session.add_all([OutboxModel(url=url, payload=data, created=created)
+                             for url, data, created in rows])
+            session.commit()
+            if not enforce:
+                return 0, None
+            dropped = self._enforce_bounds(session)
+            return dropped, self._query_totals(session)
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _enforce_bounds(self, session):
+        count, size = session.query(
+            func.count(OutboxModel.id), func.sum(func.length(OutboxModel.payload))
+        ).one()
+        size = size or 0
+        if count <= self.max_entries and size <= self.max_size:
+            return 0
+        dropped = 0
+        for robj in session.query(OutboxModel).order_by(OutboxModel.id).yield_per(100):
+            if count <= self.max_entries and size <= self.max_size:
+                break
+            count -= 1
+            size -= len(robj.payload)
+            session.delete(robj)
+            dropped += 1
+        session.commit()
+        return dropped
+
+    def pending(self, url=None):
+        if url is None:
+            return self._count
+        return self._url_pending.get(url, 0)
+
+    def _pending_urls(self):
+        # Runs in a thread.
+        session = self.db()
+        try:
+            return [x[0] for x in session.query(OutboxModel.url).distinct()]
+        finally:
+            session.close()
+
+    def _next_batch(self, url):
+        # Runs in a thread. Returns the ids, payloads and payload sizes of
+        # the oldest batch_size entries for url.
+        session = self.db()
+        try:
+            results = session.query(OutboxModel).filter_by(url=url)\
+                .order_by(OutboxModel.id).limit(self.batch_size).all()
+            return [x.id for x in results], \
+                [json.loads(x.payload) for x in results], \
+                {x.id: len(x.payload) for x in results}
+        finally:
+            session.close()
+
+    def _delete_rows(self, ids):
+        # Runs in a thread.
+        session = self.db()
+        try:
+            session.query(OutboxModel).filter(OutboxModel.id.in_(ids))\
+                .delete(synchronize_session=False)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def _remove(self, ids, url):
+        d = self._db_call(self._delete_rows, ids)
+
+        def _removed(_):
+            self._count -= len(ids)
+            self._size -= sum(self._batch_sizes.pop(x, 0) for x in ids)
+            self._url_pending[url] = max(0, self._url_pending.get(url, 0) - len(ids))
+        d.addCallback(_removed)
+        return d
+
+    def _schedule_flush(self):
+        if self._flush_call and self._flush_call.active():
+            return
+        self._flush_call = self.node.reactor.callLater(0, self.flush)
+
+    def flush(self):
+        d = self._db_call(self._pending_urls)
+
+        def _flush(urls):
+            for url in urls:
+                if url in self._flushing:
+                    continue
+                self._flush_url(url)
+
+        def _failed(failure):
+            self.log.failure("Could not read the outbox", failure=failure)
+        d.addCallbacks(_flush, _failed)
+        return d
+
+    def _flush_url(self, url):
+        d = self._db_call(self._next_batch, url)
+        self._flushing[url] = d
+
+        def _unreadable(failure):
+            if failure.check(CancelledError):
+                return
+            self.log.failure("Could not read queued payloads for {url}",
+                             failure=failure, url=url)
+            self._retry(url)
+
+        def _read(batch):
+            ids, payloads, sizes = batch
+            if not ids:
+                self._flushing.pop(url, None)
+                self._attempts.pop(url, None)
+                return
+            self._batch_sizes.update(sizes)
+            self.log.debug("Flushing {n} queued payloads to {url}",
+                           n=len(ids), url=url)
+            pd = self.node.http_post(url, **self._batch_kwargs(url, payloads))
+            self._flushing[url] = pd
+            pd.addCallback(_delivered, ids)
+            pd.addErrback(_failed, ids)
+
+        def _delivered(_, ids):
+            self._attempts.pop(url, None)
+            rd = self._remove(ids, url)
+            rd.addCallback(lambda _: self._flush_url(url))
+            return rd
+
+        def _failed(failure, ids):
+            if failure.check(CancelledError):
+                return
+            if isinstance(failure.value, HTTPError) and \
+                    400 <= failure.value.response.code < 500 and \
+                    failure.value.response.code not in (408, 429):
+                # The server will never accept this batch. Drop it rather
+                # than blocking the rest of the queue behind it.
+                self.log.error("Server rejected queued batch for {url} with "
+                               "{code}. Dropping {n} payloads.", url=url, n=len(ids),
+                               code=failure.value.response.code)
+                rd = self._remove(ids, url)
+
+                def _not_dropped(failure):
+                    self.log.failure("Could not drop rejected batch for {url}",
+                                     failure=failure, url=url)
+                    self._retry(url)
+                rd.addCallbacks(lambda _: self._flush_url(url), _not_dropped)
+                return rd
+            if not failure.check(*_http_errors):
+                # Anything unexpected, including errors removing a
+                # delivered batch, is retried like a failed delivery so
+                # that the url is never left marked as flushing.
+                self.log.failure("Error flushing queued payloads to {url}",
+                                 failure=failure, url=url)
+            self._retry(url)
+
+        d.addCallbacks(_read, _unreadable)
+        return d
+
+    def _retry(self, url):
+        self._flushing.pop(url, None)
+        attempt = self._attempts.get(url, 0) + 1
+        self._attempts[url] = attempt
+        wd = self.node.http_host_health.wait(
+            url, min_delay=self.flush_interval, attempt=attempt
+        )
+        wd.addCallback(lambda _: self._flush_url(url))
+        wd.addErrback(lambda f: f.trap(CancelledError))
+        self._flushing[url] = wd
+
+    def _batch_kwargs(self, url, payloads):
+        return {'json': payloads}
+
+    def start(self):
+        if self._loop is None:
+            self._loop = LoopingCall(self.flush)
+            self._loop.clock = self.node.reactor
+            self._loop.start(self.flush_interval, now=True)
+
+    def stop(self):
+        if self._loop and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        # Anything still buffered is written out synchronously, since the
+        # reactor may not get to run a thread callback again.
+        if self._write_call is not None and self._write_call.active():
+            self._write_call.cancel()
+        self._write_call = None
+        if self._buffer:
+            rows, self._buffer = self._buffer, []
+            self._write_rows(rows, self._over_bounds)
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        for d in self._flushing.values():
+            d.cancel()
+        self._flushing = {}
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db_engine = create_engine(self.db_url)
+            metadata.create_all(self._db_engine)
+            self._db = sessionmaker(expire_on_commit=False)
+            self._db.configure(bind=self._db_engine)
+        return self._db
+
+    @property
+    def db_url(self):
+        return 'sqlite:///{0}'.format(self.db_path)
+
+    @property
+    def db_path(self):
+        return os.path.join(self.node.db_dir, 'outbox.db')
@@ -0,0 +1,229 @@
+
+
+from zope.interface import implementer
+from twisted.internet.abstract import isIPAddress
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.address import IPv4Address
+from twisted.internet.address import IPv6Address
+from twisted.internet.defer import Deferred
+from twisted.internet.interfaces import IHostnameResolver
+from twisted.internet.interfaces import IHostResolution
+from twisted.internet.interfaces import IResolutionReceiver
+from twisted.internet.task import LoopingCall
+
+from .nodelog import NodeLogger
+
+
+@implementer(IHostResolution)
+class _HostResolution(object):
+    def __init__(self, name):
+        self.name = name
+
+    def cancel(self):
+        pass
+
+
+@implementer(IResolutionReceiver)
+class _CollectingReceiver(object):
+    def __init__(self, deferred):
+        self._deferred = deferred
+        self._addresses = []
+
+    def resolutionBegan(self, resolution):
+        pass
+
+    def addressResolved(self, address):
+        self._addresses.append(address)
+
+    def resolutionComplete(self):
+        self._deferred.callback(self._addresses)
+
+
+class _CacheEntry(object):
+    def __init__(self, addresses, now, ttl):
+        self.addresses = addresses
+        self.resolved = now
+        self.expires = now + ttl
+        self.hits = 0
+
+
+def _with_port(address, port):
+    if isinstance(address, IPv6Address):
+        return IPv6Address(address.type, address.host, port,
+                           address.flowInfo, address.scopeID)
+    return IPv4Address(address.type, address.host, port)
+
+
+@implementer(IHostnameResolver)
+class CachingHostnameResolver(object):
+    # Caching wrapper around the reactor's hostname resolver.
+    #
+    #  - Successful lookups are cached for ttl seconds. The system resolver
+    #    does not expose record TTLs, so a single configured TTL is used.
+    #  - Expired entries are kept for up to stale_ttl seconds more. If a
+    #    fresh lookup for such a host fails or takes longer than timeout
+    #    seconds, the stale addresses are used instead of failing the
+    #    connection. The lookup continues and refreshes the cache if it
+    #    eventually succeeds.
+    #  - Hosts which have been used at least popular_hits times since their
+    #    last refresh, and pinned hosts such as the HTTP proxy, are
+    #    refreshed in the background before they expire.
+    #  - Concurrent lookups for the same host share one underlying query.
+    def __init__(self, reactor, resolver, ttl=300, stale_ttl=3600,
+                 timeout=5, popular_hits=3, refresh_interval=30):
+        self._reactor = reactor
+        self._resolver = resolver
+        self._log = None
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.timeout = timeout
+        self.popular_hits = popular_hits
+        self.refresh_interval = refresh_interval
+        self._cache = {}
+        self._inflight = {}
+        self._pinned = set()
+        self._refresh_loop = None
+
+    @property
+    def log(self):
+        if not self._log:
+            self._log = NodeLogger(namespace="resolver", source=self)
+        return self._log
+
+    @property
+    def resolver(self):
+        return self._resolver
+
+    def pin(self, host_name):
+        if host_name and not isIPAddress(host_name) and \
+                not isIPv6Address(host_name):
+            self._pinned.add(host_name)
+            self._lookup((host_name, None, 'TCP'))
+
+    def unpin(self, host_name):
+        self._pinned.discard(host_name)
+
+    def _key(self, host_name, address_types, transport_semantics):
+        if address_types is not None:
+            address_types = frozenset(address_types)
+        return host_name, address_types, transport_semantics
+
+    def resolveHostName(self, resolutionReceiver, hostName, portNumber=0,
+                        addressTypes=None, transportSemantics='TCP'):
+        if isIPAddress(hostName) or isIPv6Address(hostName):
+            return self._resolver.resolveHostName(
+                resolutionReceiver, hostName, portNumber,
+                addressTypes, transportSemantics
+            )
+
+        key = self._key(hostName, addressTypes, transportSemantics)
+        now = self._reactor.seconds()
+        entry = self._cache.get(key)
+
+        resolution = _HostResolution(hostName)
+        resolutionReceiver.resolutionBegan(resolution)
+
+        def _deliver(addresses):
+            for address in addresses:
+                resolutionReceiver.addressResolved(_with_port(address, portNumber))
+            resolutionReceiver.resolutionComplete()
+
+        if entry and now < entry.expires:
+            entry.hits += 1
+            _deliver(entry.addresses)
+            return resolution
+
+        d = self._lookup(key)
+        if not entry or now > entry.expires + self.stale_ttl:
+            d.addCallback(_deliver)
+            return resolution
+
+        # We have a stale entry. Wait a bounded time for a fresh answer,
+        # and fall back to the stale one if none arrives.
+        delivered = []
+
+        def _fresh(addresses):
+            if delivered:
+                return
+            if timeout_call.active():
+                timeout_call.cancel()
+            delivered.append(True)
+            if not addresses:
+                self.log.warn("Lookup for {host} failed. Using stale addresses.",
+                              host=hostName)
+                addresses = entry.addresses
+            _deliver(addresses)
+
+        def _timed_out():
+            if delivered:
+                return
+            delivered.append(True)
+            self.log.warn("Lookup for {host} timed out. Using stale addresses.",
+                          host=hostName)
+            _deliver(entry.addresses)
+
+        timeout_call = self._reactor.callLater(self.timeout, _timed_out)
+        d.addCallback(_fresh)
+        return resolution
+
+    def _lookup(self, key):
+        # Returns a deferred firing with the list of resolved addresses,
+        # which is empty if the lookup failed. The cache is updated only
+        # on success, so a failed lookup never evicts a usable entry.
+        d = Deferred()
+        if key in self._inflight:
+            self._inflight[key].append(d)
+            return d
+        self._inflight[key] = [d]
+        host_name, address_types, transport_semantics = key
+
+        def _complete(addresses):
+            if addresses:
+                previous = self._cache.get(key)
+                entry = _CacheEntry(addresses, self._reactor.seconds(), self.ttl)
+                if previous:
+                    entry.hits = previous.hits // 2
+                self._cache[key] = entry
+            for waiter in self._inflight.pop(key, []):
+                waiter.callback(addresses)
+
+        result = Deferred()
+        result.addCallback(_complete)
+        self._resolver.resolveHostName(
+            _CollectingReceiver(result), host_name, 0,
+            address_types, transport_semantics
+        )
+        return d
+
+    def _refresh(self):
+        now = self._reactor.seconds()
+        horizon = now + self.refresh_interval * 2
+        for key, entry in list(self._cache.items()):
+            if key in self._inflight:
+                continue
+            if entry.expires > horizon:
+                continue
+            if key[0] in self._pinned or entry.hits >= self.popular_hits:
+                self._lookup(key)
+            elif now > entry.expires + self.stale_ttl:
+                del self._cache[key]
+
+    def start(self):
+        if self._refresh_loop is None:
+            self._refresh_loop = LoopingCall(self._refresh)
+            self._refresh_loop.clock = self._reactor
+            self._refresh_loop.start(self.refresh_interval, now=False)
+
+    def stop(self):
+        if self._refresh_loop and self._refresh_loop.running:
+            self._refresh_loop.stop()
+        self._refresh_loop = None
+
+    def status(self):
+        now = self._reactor.seconds()
+        return {
+            k[0]: {'addresses': [x.host for x in v.addresses],
+                   'expires_in': v.expires - now, 'hits': v.hits,
+                   'pinned': k[0] in self._pinned}
+            for k, v in self._cache.items()
+        }
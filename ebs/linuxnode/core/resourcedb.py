@@ -0,0 +1,27 @@
+
+
+from sqlalchemy import Column
+from sqlalchemy import Integer
+from sqlalchemy import Text
+from sqlalchemy.ext.declarative import declarative_base
+
+Base = declarative_base()
+metadata = Base.metadata
+
+
+class ResourceModel(Base):
+    __tablename__ = 'resources'
+
+    id = Column(Integer, primary_key=True)
+    filename = Column(Text, index=True)
+    url = Column(Text)
+    rtype = Column(Integer)
+
+
+class ResourceMirrorModel(Base):
+    __tablename__ = 'resource_mirrors'
+
+    id = Column(Integer, primary_key=True)
+    filename = Column(Text, index=True)
+    url = Column(Text)
+    position = Column(Integer)
@@ -2,50 +2,47 @@
 
 import os
 import time
-import psutil
 from datetime import datetime
 from datetime import timedelta
 from functools import partial
+from six.moves.urllib.parse import urljoin
 
-from twisted import logger
 from twisted.internet.defer import succeed
+from twisted.internet.defer import CancelledError
 from twisted.internet.task import cooperate
 from twisted.web.client import ResponseFailed
 
-from sqlalchemy import Column
-from sqlalchemy import Integer
-from sqlalchemy import Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import NoResultFound
-
+from .nodelog import NodeLogger
 from .http import HttpClientMixin
 from .http import _http_errors
+from .delta import DeltaUnavailableError
+from .delta import DeltaVerificationError
 from .config import ElementSpec, ItemSpec
+from .boot import boot_tracer
 
 from .constants import ASSET
 from .constants import CONTENT
 
-Base = declarative_base()
-metadata = Base.metadata
-
+# The SQLAlchemy models live in .resourcedb, which is only imported once
+# the resource database is first used. SQLAlchemy is by far the most
+# expensive import in the node and is not needed to start up.
+_resourcedb_names = ('Base', 'metadata', 'ResourceModel', 'ResourceMirrorModel')
 
-class ResourceModel(Base):
-    __tablename__ = 'resources'
 
-    id = Column(Integer, primary_key=True)
-    filename = Column(Text, index=True)
-    url = Column(Text)
-    rtype = Column(Integer)
+def __getattr__(name):
+    if name in _resourcedb_names:
+        from . import resourcedb
+        return getattr(resourcedb, name)
+    raise AttributeError(name)
 
 
 class CacheableResource(object):
-    def __init__(self, manager, filename, url=None, rtype=None):
+    def __init__(self, manager, filename, url=None, rtype=None, mirrors=None):
         self._manager = manager
         self._filename = filename
         self._url = url
         self._rtype = rtype
+        self._mirrors = list(mirrors or [])
         self._cache_path = None
         if not self._rtype:
             self.load()
@@ -58,6 +55,20 @@ class CacheableResource(object):
     def url(self):
         return self._url
 
+    @property
+    def mirrors(self):
+        return self._mirrors
+
+    @property
+    def urls(self):
+        # All known sources for this resource, in order of preference
+        # before any mirror ranking is applied.
+        urls = [self.url] + [x for x in self.mirrors if x != self.url]
+        lan_url = self._manager.lan_mirror_url(self.filename)
+        if lan_url:
+            urls.insert(0, lan_url)
+        return [x for x in urls if x]
+
     @property
     def rtype(self):
         return self._rtype
@@ -105,6 +116,9 @@ class CacheableResource(object):
             return False
 
     def commit(self):
+        from sqlalchemy.orm.exc import NoResultFound
+        from .resourcedb import ResourceModel
+        from .resourcedb import ResourceMirrorModel
         session = self._manager.db()
         try:
             try:
@@ -117,6 +131,14 @@ class CacheableResource(object):
             robj.rtype = self.rtype
 
             session.add(robj)
+            session.query(ResourceMirrorModel)\
+                .filter_by(filename=self.filename).delete()
+            for idx, url in enumerate(self.mirrors):
+                mobj = ResourceMirrorModel()
+                mobj.filename = self.filename
+                mobj.url = url
+                mobj.position = idx
+                session.add(mobj)
             session.flush()
             session.commit()
         except:
@@ -126,11 +148,18 @@ class CacheableResource(object):
             session.close()
 
     def load(self):
+        from .resourcedb import ResourceModel
+        from .resourcedb import ResourceMirrorModel
         session = self._manager.db()
         try:
             robj = session.query(ResourceModel).filter_by(filename=self.filename).one()
             self._url = robj.url
             self._rtype = robj.rtype
+            self._mirrors = [
+                x.url for x in session.query(ResourceMirrorModel)
+                .filter_by(filename=self.filename)
+                .order_by(ResourceMirrorModel.position)
+            ]
         except:
             session.rollback()
             raise
@@ -164,10 +193,12 @@ class ResourceManager(object):
     @property
     def log(self):
         if not self._log:
-            self._log = logger.Logger(namespace="rm", source=self)
+            self._log = NodeLogger(namespace="rm", source=self)
         return self._log
 
     def has(self, filename):
+        from sqlalchemy.orm.exc import NoResultFound
+        from .resourcedb import ResourceModel
         # Check if a resource is in defined by the manager.
         # This makes no guarantees about it existing in the cache.
         session = self.db()
@@ -189,13 +220,27 @@ class ResourceManager(object):
         # it is there.
         return self._resource_class(self, filename)
 
-    def insert(self, filename, url=None, rtype=CONTENT):
+    def insert(self, filename, url=None, rtype=CONTENT, mirrors=None):
         # Create a resource object and insert it into the manager.
         # This makes no guarantees about it existing in the cache.
-        resource = self._resource_class(self, filename, url, rtype)
+        if mirrors:
+            resource = self._resource_class(self, filename, url, rtype, mirrors=mirrors)
+        else:
+            resource = self._resource_class(self, filename, url, rtype)
         resource.commit()
 
+    def lan_mirror_url(self, filename):
+        base = self._node.config.resource_lan_mirror
+        if not base:
+            return None
+        if not base.endswith('/'):
+            base = base + '/'
+        return urljoin(base, filename)
+
     def remove(self, filename):
+        from sqlalchemy.orm.exc import NoResultFound
+        from .resourcedb import ResourceModel
+        from .resourcedb import ResourceMirrorModel
         session = self.db()
         # print("Trying to remove {0} from rdb".format(filename))
         try:
@@ -204,6 +249,8 @@ class ResourceManager(object):
             except NoResultFound:
                 return
             session.delete(robj)
+            session.query(ResourceMirrorModel)\
+                .filter_by(filename=filename).delete()
             # print("Committing rdel")
             session.commit()
         except:
@@ -231,17 +278,58 @@ class ResourceManager(object):
             failure.trap(ResponseFailed, *_http_errors)
             attempts = attempts - 1
             if attempts:
-                self._node.reactor.callLater(
-                    self._node.config.resource_prefetch_retry_delay,
-                    self.prefetch, resource, retries=attempts
+                # Retries are coordinated per host. While the host circuit
+                # is open, all pending retries wait on a single probe
+                # instead of each holding its own timer.
+                attempt = max(1, self._node.config.resource_prefetch_retries - attempts)
+                rd = self._node.http_host_health.wait(
+                    resource.url, attempt=attempt,
+                    min_delay=self._node.config.resource_prefetch_retry_delay,
                 )
+                rd.addCallback(lambda _: self.prefetch(
+                    resource, retries=attempts, semaphore=semaphore
+                ))
+                rd.addErrback(lambda f: f.trap(CancelledError))
         d.addErrback(partial(_retry, attempts=retries))
         return d
 
+    def refresh(self, resource, semaphore=None):
+        # Bring a cached resource up to date with its upstream version.
+        # If delta updates are enabled, only the blocks which differ from
+        # the cached copy are downloaded. The cached copy is replaced
+        # atomically once the new version is complete.
+        if resource.filename in self._active_downloads:
+            return
+        if not resource.available:
+            return self.prefetch(resource, semaphore=semaphore)
+        if not self._node.config.resource_delta_updates:
+            return self._fetch(resource, semaphore=semaphore)
+
+        self._active_downloads.append(resource.filename)
+        self.log.info("Requesting delta update of {filename}", filename=resource.filename)
+        d = self._node.http_download_delta(resource.url, resource.cache_path,
+                                           semaphore=semaphore)
+
+        def _vacate_download(maybe_failure):
+            self._active_downloads.remove(resource.filename)
+            return maybe_failure
+        d.addBoth(_vacate_download)
+
+        def _fallback(failure):
+            failure.trap(DeltaUnavailableError, DeltaVerificationError)
+            self.log.info("Delta update of {filename} not possible. "
+                          "Downloading in full.", filename=resource.filename)
+            return self._fetch(resource, semaphore=semaphore)
+        d.addErrback(_fallback)
+        return d
+
     def _fetch(self, resource, semaphore=None):
         self._active_downloads.append(resource.filename)
         self.log.info("Requesting download of {filename}", filename=resource.filename)
-        d = self._node.http_download(resource.url, resource.cache_path, semaphore=semaphore)
+        urls = resource.urls
+        if len(urls) < 2:
+            urls = resource.url
+        d = self._node.http_download(urls, resource.cache_path, semaphore=semaphore)
 
         # Update timestamps for the downloaded file to reflect start of
         # download instead of end. Consider if this is wise.
@@ -284,10 +372,14 @@ class ResourceManager(object):
     @property
     def db(self):
         if self._db is None:
-            self._db_engine = create_engine(self.db_url)
-            metadata.create_all(self._db_engine)
-            self._db = sessionmaker(expire_on_commit=False)
-            self._db.configure(bind=self._db_engine)
+            with boot_tracer.phase('resource_db'):
+                from sqlalchemy import create_engine
+                from sqlalchemy.orm import sessionmaker
+                from .resourcedb import metadata
+                self._db_engine = create_engine(self.db_url)
+                metadata.create_all(self._db_engine)
+                self._db = sessionmaker(expire_on_commit=False)
+                self._db.configure(bind=self._db_engine)
         return self._db
 
     @property
@@ -532,10 +624,15 @@ class ResourceManagerMixin(HttpClientMixin):
 
     def install(self):
         super(ResourceManagerMixin, self).install()
-        _default_cache_size = int((psutil.disk_usage('/').total - 5000000000) * 0.7)
+
+        def _default_cache_size(config):
+            import psutil
+            return int((psutil.disk_usage('/').total - 5000000000) * 0.7)
         _elements = {
             'resource_prefetch_retries': ElementSpec('resources', 'prefetch_retries', ItemSpec(int, fallback=6)),
             'resource_prefetch_retry_delay': ElementSpec('resources', 'prefetch_retry_delay', ItemSpec(int, fallback=60)),
+            'resource_lan_mirror': ElementSpec('resources', 'lan_mirror', ItemSpec(fallback=None)),
+            'resource_delta_updates': ElementSpec('resources', 'delta_updates', ItemSpec(bool, fallback=False)),
             'cache_max_size': ElementSpec('cache', 'max_size', ItemSpec(int, fallback=_default_cache_size))
         }
         for name, spec in _elements.items():
@@ -544,10 +641,11 @@ class ResourceManagerMixin(HttpClientMixin):
     @property
     def resource_manager(self):
         if not self._resource_manager:
-            self.log.info("Initializing resource manager")
-            self._resource_manager = CachingResourceManager(
-                self, resource_class=self._resource_class,
-            )
+            with boot_tracer.phase('resource_manager'):
+                self.log.info("Initializing resource manager")
+                self._resource_manager = CachingResourceManager(
+                    self, resource_class=self._resource_class,
+                )
         return self._resource_manager
 
     @property
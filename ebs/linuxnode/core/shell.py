@@ -1,30 +1,131 @@
 
 
+import re
+import time
+import codecs
 from os import environ
 from twisted.internet.utils import getProcessOutput
+from twisted.internet.defer import Deferred
+from twisted.internet.defer import succeed
+from twisted.internet.defer import maybeDeferred
+from twisted.python.failure import Failure
 from twisted.internet.error import ProcessExitedAlready
 from twisted.internet.protocol import ProcessProtocol
 from .basemixin import BaseMixin
 from .config import ConfigMixin
+from .config import ElementSpec, ItemSpec
+from .nodelog import NodeLogger
+from .supervisor import ProcessSupervisor
+
+
+class LineFramer(object):
+    # Splits a stream of bytes into lines, as the chunks arrive.
+    #
+    # Lines may end in \n, \r\n or a bare \r, which progress output from
+    # tools like ffmpeg uses to redraw a line. Bytes are decoded
+    # incrementally, so multi byte characters split across chunks survive.
+    # A line longer than max_length is delivered in pieces instead of
+    # growing the buffer without bound. Lines are stripped, and empty
+    # lines are dropped.
+    _breaks = re.compile('\r\n|\r|\n')
+
+    def __init__(self, max_length=65536, encoding='utf-8'):
+        self.max_length = max_length
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self._buffer = ''
+        self._cr = False
+
+    def feed(self, data, final=False):
+        text = self._decoder.decode(data, final=final)
+        if self._cr and text.startswith('\n'):
+            # The rest of a \r\n split across chunks.
+            text = text[1:]
+            self._cr = False
+        if text:
+            self._cr = text.endswith('\r')
+        parts = self._breaks.split(self._buffer + text)
+        self._buffer = parts.pop()
+        if final:
+            parts.append(self._buffer)
+            self._buffer = ''
+        while len(self._buffer) > self.max_length:
+            parts.append(self._buffer[:self.max_length])
+            self._buffer = self._buffer[self.max_length:]
+        return [x for x in (part.strip() for part in parts) if x]
+
+    def flush(self):
+        return self.feed(b'', final=True)
 
 
 class ProcessClient(ProcessProtocol):
+    # Delivers the output of a child process to line_handler one line at a
+    # time. Output on stderr, which is only separate when the process is
+    # not run in a PTY, goes to err_line_handler, or to the debug log.
+    #
+    # With batch=True, the handlers are instead called with a list of all
+    # the lines received in a reactor turn, which keeps chatty children
+    # from costing a Python call per line.
     def __init__(self, line_handler=None, exit_handler=None,
-                 name=None, *args, **kwargs):
+                 name=None, err_line_handler=None, batch=False,
+                 max_line_length=65536, reactor=None, *args, **kwargs):
         super(ProcessClient, self).__init__(*args, **kwargs)
         self._line_handler = line_handler
+        self._err_line_handler = err_line_handler
         self._exit_handler = exit_handler
         self._name = name
+        self._batch = batch
+        self._reactor = reactor
+        self._out = LineFramer(max_line_length)
+        self._err = LineFramer(max_line_length)
+        self._pending = {}
+        self._delivery = None
+        self._log = None
+
+    @property
+    def log(self):
+        if not self._log:
+            self._log = NodeLogger(namespace="shell", source=self)
+        return self._log
+
+    @property
+    def reactor(self):
+        if self._reactor is None:
+            from twisted.internet import reactor
+            self._reactor = reactor
+        return self._reactor
+
+    def _err_lines(self, lines):
+        for line in lines:
+            self.log.debug("{name} : {line}", name=self._name, line=line)
+
+    def _handle(self, handler, lines):
+        if not lines or not handler:
+            return
+        if not self._batch:
+            for line in lines:
+                handler(line)
+            return
+        self._pending.setdefault(handler, []).extend(lines)
+        if self._delivery is None:
+            self._delivery = self.reactor.callLater(0, self._deliver)
+
+    def _deliver(self):
+        if self._delivery is not None and self._delivery.active():
+            self._delivery.cancel()
+        self._delivery = None
+        pending, self._pending = self._pending, {}
+        for handler, lines in pending.items():
+            handler(lines)
 
     def connectionMade(self):
         pass
 
     def outReceived(self, data: bytes):
-        if self._line_handler:
-            self._line_handler(data.strip().decode())
+        self._handle(self._line_handler, self._out.feed(data))
 
     def errReceived(self, data):
-        pass
+        self._handle(self._err_line_handler or self._err_lines,
+                     self._err.feed(data))
 
     def inConnectionLost(self):
         # stdin is closed. (we probably did it)"
@@ -32,16 +133,20 @@ class ProcessClient(ProcessProtocol):
 
     def outConnectionLost(self):
         # The child closed their stdout.
-        pass
+        self._handle(self._line_handler, self._out.flush())
 
     def errConnectionLost(self):
         # The child closed their stderr.
-        pass
+        self._handle(self._err_line_handler or self._err_lines,
+                     self._err.flush())
 
     def processExited(self, reason):
         pass
 
     def processEnded(self, reason):
+        # Output still held for the end of the turn goes out before the
+        # exit is reported.
+        self._deliver()
         if self._exit_handler:
             self._exit_handler(reason.value.exitCode)
 
@@ -49,45 +154,198 @@ class ProcessClient(ProcessProtocol):
 class BaseShellMixin(ConfigMixin, BaseMixin):
     def __init__(self, *args, **kwargs):
         self._shell_processes = {}
+        self._shell_supervisors = {}
+        self._shell_ttls = {}
+        self._shell_cache = {}
         super(BaseShellMixin, self).__init__(*args, **kwargs)
 
-    def _shell_execute(self, command, response_handler):
+    def install(self):
+        super(BaseShellMixin, self).install()
+        _elements = {
+            'shell_restart_backoff': ElementSpec('shell', 'restart_backoff', ItemSpec(float, fallback=1.0)),
+            'shell_restart_backoff_max': ElementSpec('shell', 'restart_backoff_max', ItemSpec(float, fallback=60.0)),
+            'shell_sample_interval': ElementSpec('shell', 'sample_interval', ItemSpec(float, fallback=5.0)),
+        }
+        for element, element_spec in _elements.items():
+            self.config.register_element(element, element_spec)
+
+    def _shell_execute(self, command, response_handler, ttl=None,
+                       stale=None, env=None):
+        # Runs command, a list of the executable and its arguments, and
+        # calls response_handler with its output.
+        #
+        # Commands which are polled, such as vcgencmd or df, can be
+        # memoized by giving a ttl in seconds, here or for the executable
+        # with shell_cache_ttl(). Output up to ttl seconds old is returned
+        # without running the command. Output up to a further stale seconds
+        # old is returned as well, while the command is rerun in the
+        # background to refresh it. Concurrent calls for the same command
+        # and env share a single process. Failures are never cached.
+        if ttl is None:
+            ttl, default_stale = self._shell_ttls.get(command[0], (None, None))
+            if stale is None:
+                stale = default_stale
+        if not ttl:
+            d = self._shell_run(command, env)
+        else:
+            d = self._shell_cached(command, env, ttl, stale or 0)
+        d.addCallback(response_handler)
+        return d
+
+    def shell_cache_ttl(self, executable, ttl, stale=None):
+        # Memoize the output of executable for ttl seconds. See
+        # _shell_execute.
+        self._shell_ttls[executable] = (ttl, stale)
+
+    def shell_cache_invalidate(self, executable=None):
+        # Output from a run already in flight still goes to its waiters,
+        # but is not cached, since it may predate the invalidation.
+        for key in list(self._shell_cache.keys()):
+            if executable is None or key[0][0] == executable:
+                entry = self._shell_cache[key]
+                if entry['waiters'] is None:
+                    del self._shell_cache[key]
+                else:
+                    entry['time'] = None
+                    entry['generation'] += 1
+
+    def _shell_run(self, command, env=None):
         if len(command) > 1:
             args = command[1:]
         else:
             args = []
-        d = getProcessOutput(command[0], args, env=environ)
-        d.addCallback(response_handler)
+        return getProcessOutput(command[0], args,
+                                env=environ if env is None else env)
+
+    def _shell_cached(self, command, env, ttl, stale):
+        key = (tuple(command),
+               None if env is None else tuple(sorted(env.items())))
+        entry = self._shell_cache.get(key)
+        if entry is None:
+            entry = {'value': None, 'time': None, 'waiters': None,
+                     'generation': 0}
+            self._shell_cache[key] = entry
+
+        age = None
+        if entry['time'] is not None:
+            age = time.monotonic() - entry['time']
+        if age is not None and age < ttl:
+            return succeed(entry['value'])
+        if age is not None and age < ttl + stale:
+            self._shell_refresh(key, command, env)
+            return succeed(entry['value'])
+
+        d = Deferred()
+        self._shell_refresh(key, command, env, waiter=d)
         return d
 
+    def _shell_refresh(self, key, command, env, waiter=None):
+        entry = self._shell_cache[key]
+        if entry['waiters'] is not None:
+            # Already running.
+            if waiter is not None:
+                entry['waiters'].append(waiter)
+            return
+        entry['waiters'] = [waiter] if waiter is not None else []
+        generation = entry['generation']
+
+        def _done(result):
+            waiters, entry['waiters'] = entry['waiters'], None
+            if isinstance(result, Failure):
+                if not waiters:
+                    self.log.warn("Could not refresh output of {command} : {e}",
+                                  command=command, e=result.value)
+                for waiter in waiters:
+                    waiter.errback(result)
+                return
+            if entry['generation'] == generation:
+                entry['value'] = result
+                entry['time'] = time.monotonic()
+            for waiter in waiters:
+                waiter.callback(result)
+        maybeDeferred(self._shell_run, command, env).addBoth(_done)
+
     def shell_process(self, executable, args=None, env=None,
-                      protocol=None, usePTY=True,
-                      line_handler=None, exit_handler=None, name=None):
+                      protocol=None, usePTY=None,
+                      line_handler=None, exit_handler=None, name=None,
+                      err_line_handler=None, batch=False,
+                      supervise=False, **supervision):
+        # With supervise=True, the process is restarted with backoff when
+        # it exits, and can be given a nice value, CPU affinity and
+        # rlimits. See ProcessSupervisor for the options accepted in
+        # supervision. Returns the supervisor, which also provides CPU and
+        # memory use through stats().
+        #
+        # Unless usePTY is given, line handled processes run without a PTY
+        # when err_line_handler is given, so that stderr reaches it, and in
+        # a PTY otherwise.
         if not name:
             name = executable
 
         if protocol:
-            client = protocol()
+            factory = protocol
+            if usePTY is None:
+                usePTY = True
         elif line_handler:
-            usePTY = True
-            client = ProcessClient(
-                exit_handler=exit_handler,
-                line_handler=line_handler,
-                name=name
-            )
+            # stderr can only be told apart from stdout without a PTY.
+            if usePTY is None:
+                usePTY = not err_line_handler
+
+            def factory():
+                return ProcessClient(
+                    exit_handler=exit_handler,
+                    line_handler=line_handler,
+                    err_line_handler=err_line_handler,
+                    batch=batch,
+                    name=name,
+                    reactor=self.reactor
+                )
         else:
             raise AttributeError("Either protocol or line_handler must be provided")
 
-        self._shell_processes[name] = client
         if not args:
             args = []
         if not len(args) or args[0] != executable:
             args.insert(0, executable)
-        self.reactor.spawnProcess(client, executable, args=args, env=env, usePTY=usePTY)
+
+        if not supervise:
+            client = factory()
+            self._shell_processes[name] = client
+            self.reactor.spawnProcess(client, executable, args=args, env=env, usePTY=usePTY)
+            return
+
+        supervision.setdefault('backoff', self.config.shell_restart_backoff)
+        supervision.setdefault('backoff_max', self.config.shell_restart_backoff_max)
+        supervision.setdefault('sample_interval', self.config.shell_sample_interval)
+        previous = self._shell_supervisors.get(name)
+        if previous:
+            previous.stop()
+
+        def _spawned(client):
+            self._shell_processes[name] = client
+        supervisor = ProcessSupervisor(
+            name, executable, args, factory, self.reactor,
+            env=env, usePTY=usePTY, on_spawn=_spawned, **supervision
+        )
+        self._shell_supervisors[name] = supervisor
+        supervisor.start()
+        return supervisor
+
+    def shell_process_stats(self, name=None):
+        # Stats of supervised processes, by name.
+        if name is not None:
+            return self._shell_supervisors[name].stats()
+        return {name: supervisor.stats()
+                for name, supervisor in self._shell_supervisors.items()}
 
     def stop(self):
         super(BaseShellMixin, self).stop()
+        for name, supervisor in self._shell_supervisors.items():
+            supervisor.stop()
+            self.log.info(f"Stopped supervised child process {name}")
         for name, process in self._shell_processes.items():
+            if name in self._shell_supervisors:
+                continue
             try:
                 process.transport.signalProcess('TERM')
                 process.transport.loseConnection()
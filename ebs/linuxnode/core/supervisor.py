@@ -0,0 +1,208 @@
+
+
+import time
+
+from twisted.internet.task import LoopingCall
+from twisted.internet.error import ProcessExitedAlready
+
+from .nodelog import NodeLogger
+
+
+class ProcessSupervisor(object):
+    # Runs a child process and keeps it running.
+    #
+    #  - When the child exits for any reason other than stop(), it is
+    #    spawned again after a delay which starts at backoff and doubles
+    #    with every consecutive failure, up to backoff_max. A child which
+    #    ran for at least backoff_reset seconds resets the delay. After
+    #    max_restarts consecutive restarts, if given, it is left stopped.
+    #  - nice, affinity (a list of CPUs) and rlimits are applied to the
+    #    child as soon as it is spawned. rlimits maps resource names, such
+    #    as 'as', 'cpu' or 'nofile', to a limit or a (soft, hard) tuple.
+    #  - The CPU use and RSS of the child are sampled every
+    #    sample_interval seconds, and are available from stats().
+    #
+    # protocol_factory is called for every spawn and should return a fresh
+    # ProcessProtocol.
+    def __init__(self, name, executable, args, protocol_factory, reactor,
+                 env=None, usePTY=False, restart=True,
+                 backoff=1.0, backoff_max=60.0, backoff_reset=30.0,
+                 max_restarts=None, nice=None, affinity=None, rlimits=None,
+                 sample_interval=5.0, on_spawn=None):
+        self.name = name
+        self.executable = executable
+        self.args = args
+        self.env = env
+        self.usePTY = usePTY
+        self.restart = restart
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.backoff_reset = backoff_reset
+        self.max_restarts = max_restarts
+        self.nice = nice
+        self.affinity = affinity
+        self.rlimits = rlimits or {}
+        self.sample_interval = sample_interval
+        self._protocol_factory = protocol_factory
+        self._on_spawn = on_spawn
+        self._reactor = reactor
+        self._log = None
+
+        self.protocol = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_exit = None
+        self._started_at = None
+        self._stopping = False
+        self._restart_call = None
+        self._sampler = None
+        self._process = None
+        self._sample = {'cpu_percent': None, 'rss': None}
+
+    @property
+    def log(self):
+        if not self._log:
+            self._log = NodeLogger(namespace="shell.{0}".format(self.name),
+                                   source=self)
+        return self._log
+
+    @property
+    def pid(self):
+        if self.protocol is None or self.protocol.transport is None:
+            return None
+        return self.protocol.transport.pid
+
+    @property
+    def running(self):
+        return self.pid is not None
+
+    def start(self):
+        self._stopping = False
+        if not self.running:
+            self._spawn()
+
+    def _spawn(self):
+        self._restart_call = None
+        protocol = self._protocol_factory()
+        process_ended = protocol.processEnded
+
+        def _ended(reason):
+            try:
+                process_ended(reason)
+            finally:
+                self._ended(protocol, reason)
+        protocol.processEnded = _ended
+
+        self.protocol = protocol
+        self._started_at = time.monotonic()
+        self._reactor.spawnProcess(protocol, self.executable, args=self.args,
+                                   env=self.env, usePTY=self.usePTY)
+        self.log.info("Started {name} with pid {pid}", name=self.name, pid=self.pid)
+        self._apply_limits()
+        self._start_sampling()
+        if self._on_spawn:
+            self._on_spawn(protocol)
+
+    def _apply_limits(self):
+        if self.nice is None and not self.affinity and not self.rlimits:
+            return
+        import psutil
+        import resource
+        try:
+            process = psutil.Process(self.pid)
+            if self.nice is not None:
+                process.nice(self.nice)
+            if self.affinity:
+                process.cpu_affinity(list(self.affinity))
+            for name, limit in self.rlimits.items():
+                if not isinstance(limit, (tuple, list)):
+                    limit = (limit, limit)
+                rlimit = getattr(resource, 'RLIMIT_{0}'.format(name.upper()))
+                process.rlimit(rlimit, tuple(limit))
+        except (psutil.Error, AttributeError, ValueError, OSError) as e:
+            self.log.warn("Could not apply limits to {name} : {e}",
+                          name=self.name, e=e)
+
+    def _start_sampling(self):
+        if not self.sample_interval:
+            return
+        import psutil
+        try:
+            self._process = psutil.Process(self.pid)
+            # The first call only establishes the baseline.
+            self._process.cpu_percent()
+        except psutil.Error:
+            self._process = None
+            return
+        if self._sampler is None:
+            self._sampler = LoopingCall(self._take_sample)
+            self._sampler.clock = self._reactor
+            self._sampler.start(self.sample_interval, now=False)
+
+    def _take_sample(self):
+        import psutil
+        if self._process is None:
+            return
+        try:
+            with self._process.oneshot():
+                self._sample = {
+                    'cpu_percent': self._process.cpu_percent(),
+                    'rss': self._process.memory_info().rss,
+                }
+        except psutil.Error:
+            self._process = None
+
+    def _stop_sampling(self):
+        if self._sampler is not None and self._sampler.running:
+            self._sampler.stop()
+        self._sampler = None
+        self._process = None
+
+    def _ended(self, protocol, reason):
+        if protocol is not self.protocol:
+            return
+        code = getattr(reason.value, 'exitCode', None)
+        signal = getattr(reason.value, 'signal', None)
+        self.last_exit = {'code': code, 'signal': signal, 'time': time.time()}
+        self._stop_sampling()
+        self.protocol = None
+        if self._stopping or not self.restart:
+            return
+
+        if time.monotonic() - self._started_at >= self.backoff_reset:
+            self.failures = 0
+        if self.max_restarts is not None and self.failures >= self.max_restarts:
+            self.log.error("{name} exited with {code}, giving up after "
+                           "{n} restarts", name=self.name, code=code, n=self.failures)
+            return
+        delay = min(self.backoff * (2 ** self.failures), self.backoff_max)
+        self.failures += 1
+        self.restarts += 1
+        self.log.warn("{name} exited with {code}, restarting in {delay}s",
+                      name=self.name, code=code, delay=delay)
+        self._restart_call = self._reactor.callLater(delay, self._spawn)
+
+    def stop(self, signal='TERM'):
+        self._stopping = True
+        if self._restart_call is not None and self._restart_call.active():
+            self._restart_call.cancel()
+        self._restart_call = None
+        if self.protocol is None:
+            return
+        try:
+            self.protocol.transport.signalProcess(signal)
+            self.protocol.transport.loseConnection()
+        except ProcessExitedAlready:
+            pass
+
+    def stats(self):
+        stats = {
+            'name': self.name,
+            'pid': self.pid,
+            'running': self.running,
+            'uptime': time.monotonic() - self._started_at if self.running else None,
+            'restarts': self.restarts,
+            'last_exit': self.last_exit,
+        }
+        stats.update(self._sample if self.running else {'cpu_percent': None, 'rss': None})
+        return stats
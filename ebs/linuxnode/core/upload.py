@@ -0,0 +1,161 @@
+
+
+import os
+import mimetypes
+
+from zope.interface import implementer
+from twisted.internet import task
+from twisted.internet.defer import Deferred
+from twisted.web.iweb import IBodyProducer
+
+
+UPLOAD_READ_SIZE = 2 ** 16
+
+
+class UploadInterruptedError(Exception):
+    # Raised by chunked uploads when a part fails. offset is the number of
+    # bytes known to have been accepted by the server, and can be passed
+    # back to resume the upload.
+    def __init__(self, path, offset, reason):
+        self.path = path
+        self.offset = offset
+        self.reason = reason
+
+    def __repr__(self):
+        return f"Upload of {self.path} interrupted at {self.offset} : {self.reason}"
+
+
+class _CountingConsumer(object):
+    def __init__(self, consumer, callback):
+        self._consumer = consumer
+        self._callback = callback
+
+    def registerProducer(self, producer, streaming):
+        self._consumer.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._consumer.unregisterProducer()
+
+    def write(self, data):
+        self._consumer.write(data)
+        self._callback(len(data))
+
+
+@implementer(IBodyProducer)
+class ProgressBodyProducer(object):
+    # Wraps another IBodyProducer, reporting (sent, total) to the progress
+    # callback as bytes are handed to the transport. Backpressure is
+    # handled entirely by the wrapped producer.
+    def __init__(self, producer, progress=None, offset=0, total=None):
+        self._producer = producer
+        self._progress = progress
+        self.length = producer.length
+        self.sent = offset
+        self.total = total
+        if self.total is None and isinstance(self.length, int):
+            self.total = offset + self.length
+
+    def _written(self, n):
+        self.sent += n
+        if self._progress:
+            self._progress(self.sent, self.total)
+
+    def startProducing(self, consumer):
+        return self._producer.startProducing(
+            _CountingConsumer(consumer, self._written)
+        )
+
+    def pauseProducing(self):
+        self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self._producer.resumeProducing()
+
+    def stopProducing(self):
+        self._producer.stopProducing()
+
+
+@implementer(IBodyProducer)
+class FileSliceBodyProducer(object):
+    # Produces length bytes of the file at path starting at offset, reading
+    # read_size bytes at a time. Only one chunk is ever held in memory.
+    def __init__(self, path, offset=0, length=None,
+                 read_size=UPLOAD_READ_SIZE, cooperator=task):
+        self._path = path
+        self._offset = offset
+        if length is None:
+            length = os.path.getsize(path) - offset
+        self.length = length
+        self._read_size = read_size
+        self._cooperate = cooperator.cooperate
+        self._file = None
+        self._task = None
+
+    def _write_loop(self, consumer):
+        remaining = self.length
+        while remaining > 0:
+            data = self._file.read(min(self._read_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            consumer.write(data)
+            yield None
+
+    def startProducing(self, consumer):
+        self._file = open(self._path, 'rb')
+        self._file.seek(self._offset)
+        self._task = self._cooperate(self._write_loop(consumer))
+        d = self._task.whenDone()
+
+        def _close(result):
+            self._close()
+            return result
+
+        def _stopped(failure):
+            # As with FileBodyProducer, the deferred never fires once the
+            # consumer has stopped the producer.
+            failure.trap(task.TaskStopped)
+            return Deferred()
+        d.addBoth(_close)
+        d.addCallbacks(lambda _: None, _stopped)
+        return d
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def pauseProducing(self):
+        self._task.pause()
+
+    def resumeProducing(self):
+        self._task.resume()
+
+    def stopProducing(self):
+        try:
+            self._task.stop()
+        except task.TaskFinished:
+            pass
+        self._close()
+
+
+def multipart_producer(files, data=None, read_size=UPLOAD_READ_SIZE):
+    # Build a streaming multipart/form-data producer. files maps field
+    # names to either a path or a (filename, content_type, path) tuple.
+    # Returns the producer and the Content-Type header value to use.
+    from treq.multipart import MultiPartProducer
+    fields = []
+    for name, value in (data or {}).items():
+        fields.append((name, value))
+    for name, value in files.items():
+        if isinstance(value, (tuple, list)):
+            filename, content_type, path = value
+        else:
+            path = value
+            filename = os.path.basename(path)
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        fields.append((name, (filename, content_type,
+                              FileSliceBodyProducer(path, read_size=read_size))))
+    producer = MultiPartProducer(fields)
+    content_type = b"multipart/form-data; boundary=" + producer.boundary
+    return producer, content_type
@@ -1,44 +1,171 @@
 
 
 import os
-from twisted import logger
 
+from sqlalchemy import bindparam
 from sqlalchemy import create_engine
+from sqlalchemy import inspect as sa_inspect
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
+from ..core.nodelog import NodeLogger
+
 
 class GenericSequencePersistenceManager(object):
     _db_name = 'generic'
     _db_model = None
     _db_metadata = None
+    _db_page_size = 256
 
     def __init__(self, actual):
         self._actual = actual
         self._items = []
-        self._is_loaded = False
+        self._version = 0
+        self._loaded_version = None
         self._log = None
 
         self._db_engine = None
         self._db = None
         self._db_dir = None
+        self._db_column_map = None
+        self._db_unhashable = False
         _ = self.db
 
     @property
     def log(self):
         if not self._log:
-            self._log = logger.Logger(
+            self._log = NodeLogger(
                 namespace="{0}.pm".format(self._db_name),
                 source=self
             )
         return self._log
 
     def get(self, reload=True):
-        self._persistence_load(force=reload)
-        return self._items
+        # Items are cached in memory along with the version they were
+        # loaded at. The version is bumped by every write made through this
+        # manager, so get() only goes to the database after a change. If
+        # the database is written to by anything else, call invalidate().
+        # reload=False returns the cached items even if they are stale.
+        if reload or self._loaded_version is None:
+            self._persistence_load()
+        return list(self._items)
+
+    def invalidate(self):
+        self._version += 1
 
     def update(self, items):
-        self._is_loaded = False
+        # Persists items as the new sequence, touching only what changed.
+        #
+        # Rows are compared with the rows for the new items by their
+        # content, which is every column other than the primary key and
+        # seq. Existing rows whose content appears in the new sequence are
+        # kept, and only have their seq updated if they moved. The rest
+        # are deleted, and rows are inserted for new items. _clear_item
+        # and _insert_item are only called for deleted and inserted rows.
+        # All changes are made in one transaction.
+        #
+        # The rows for the new items are compared before they are flushed,
+        # so column defaults have not been applied to them. Scalar defaults
+        # are filled in for the comparison. Columns with other defaults,
+        # such as callables or server defaults, never match, and rows which
+        # rely on them are always replaced. Models whose column values
+        # cannot be hashed, such as JSON or PickleType columns holding
+        # dicts or lists, are always rewritten in full.
+        if not self._db_diffable:
+            return self._update_full(items)
+        session = self.db()
+        unhashable = False
+        try:
+            existing = self.db_get_resources(session).all()
+            if not existing and not len(items):
+                return
+            self.log.debug("Updating Items in DB '{}'"
+                           "".format(self._db_name))
+            diff = self._db_diff(existing, items)
+            if diff is None:
+                unhashable = True
+            else:
+                deletes, moves, inserts = diff
+                self._db_apply(session, deletes, moves, inserts)
+                session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+            self.invalidate()
+        if unhashable:
+            self._db_unhashable = True
+            return self._update_full(items)
+        self.log.debug("Updated DB '{}' : {} inserted, {} deleted, {} moved"
+                       "".format(self._db_name, len(inserts),
+                                 len(deletes), len(moves)))
+
+    def _db_diff(self, existing, items):
+        # Returns None if the content of the rows cannot be hashed.
+        available = {}
+        for robj in existing:
+            content = self._db_content(robj)
+            try:
+                available.setdefault(content, []).append(robj)
+            except TypeError:
+                return None
+
+        inserts, moves = [], []
+        for idx, item in enumerate(items):
+            robj = self._db_model(idx, item)
+            content = self._db_content(robj, transient=True)
+            try:
+                candidates = available.get(content)
+            except TypeError:
+                return None
+            if not candidates:
+                inserts.append((idx, item, robj))
+                continue
+            # Prefer a row which is already in the right place.
+            match = next((x for x in candidates if x.seq == idx),
+                         candidates[0])
+            candidates.remove(match)
+            if match.seq != idx:
+                moves.append((self._db_pk_value(match), idx))
+        deletes = [robj for rows in available.values() for robj in rows]
+        return deletes, moves, inserts
+
+    def _db_apply(self, session, deletes, moves, inserts):
+        table = self.db_model.__table__
+        pk = self._db_columns['pk']
+        seq = self._db_columns['seq']
+        if deletes:
+            for robj in deletes:
+                self._clear_item(robj)
+            ids = [self._db_pk_value(robj) for robj in deletes]
+            for start in range(0, len(ids), 500):
+                session.execute(table.delete().where(
+                    pk.in_(ids[start:start + 500])
+                ))
+        if moves:
+            # seq may be unique or even the primary key, so moved rows are
+            # first parked at negative positions to avoid collisions on the
+            # way to their new ones.
+            statement = table.update().where(
+                pk == bindparam('b_pk')
+            ).values({seq.name: bindparam('b_seq')})
+            parked = [{'b_pk': x, 'b_seq': -1 - idx} for x, idx in moves]
+            session.execute(statement, parked)
+            if pk is seq:
+                final = [{'b_pk': -1 - idx, 'b_seq': idx} for x, idx in moves]
+            else:
+                final = [{'b_pk': x, 'b_seq': idx} for x, idx in moves]
+            session.execute(statement, final)
+        if inserts:
+            for idx, item, robj in inserts:
+                self._insert_item(idx, item)
+            # The loaded rows are stale now, and their identities may be
+            # reused by the new rows.
+            session.expunge_all()
+            session.add_all([robj for idx, item, robj in inserts])
+
+    def _update_full(self, items):
         self.clear()
         if not len(items):
             return
@@ -57,6 +184,55 @@ class GenericSequencePersistenceManager(object):
             raise
         finally:
             session.close()
+            self.invalidate()
+
+    @property
+    def _db_columns(self):
+        # Primary key and seq columns of the model, and the attributes
+        # which make up the content of a row.
+        if self._db_column_map is None:
+            mapper = sa_inspect(self.db_model)
+            pks = mapper.primary_key
+            columns = {
+                'pk': pks[0] if len(pks) == 1 else None,
+                'seq': None,
+                'content': [],
+            }
+            for attr in mapper.column_attrs:
+                column = attr.columns[0]
+                if attr.key == 'seq':
+                    columns['seq'] = column
+                elif column not in pks:
+                    default = column.default
+                    if default is not None and default.is_scalar:
+                        default = default.arg
+                    else:
+                        default = None
+                    columns['content'].append((attr.key, default))
+            columns['pk_key'] = next(
+                (attr.key for attr in mapper.column_attrs
+                 if attr.columns[0] is columns['pk']), None
+            )
+            self._db_column_map = columns
+        return self._db_column_map
+
+    @property
+    def _db_diffable(self):
+        columns = self._db_columns
+        return columns['pk'] is not None and columns['seq'] is not None and \
+            not self._db_unhashable
+
+    def _db_content(self, robj, transient=False):
+        content = []
+        for key, default in self._db_columns['content']:
+            value = getattr(robj, key)
+            if transient and value is None:
+                value = default
+            content.append(value)
+        return tuple(content)
+
+    def _db_pk_value(self, robj):
+        return getattr(robj, self._db_columns['pk_key'])
 
     def _insert_item(self, seq, item):
         pass
@@ -65,7 +241,6 @@ class GenericSequencePersistenceManager(object):
         pass
 
     def clear(self):
-        self._is_loaded = False
         session = self.db()
         self.log.debug("Clearing Persistent Items from DB '{}'"
                        "".format(self._db_name))
@@ -76,17 +251,19 @@ class GenericSequencePersistenceManager(object):
             return
         try:
             for robj in results:
-                session.delete(robj)
                 self._clear_item(robj)
+            session.execute(self.db_model.__table__.delete())
             session.commit()
         except:
             session.rollback()
             raise
         finally:
             session.close()
+            self.invalidate()
 
     def _persistence_load(self, force=False):
-        if self._is_loaded and not force:
+        version = self._version
+        if self._loaded_version == version and not force:
             return
         self.log.debug("Loading Persistent Items from DB '{}'"
                        "".format(self._db_name))
@@ -103,9 +280,52 @@ class GenericSequencePersistenceManager(object):
         finally:
             session.close()
         self._items = _items
+        self._loaded_version = version
         self.log.debug("Got {} Items from DB '{}'."
                        "".format(len(self._items), self._db_name))
 
+    def iterate(self, start=None, page_size=None):
+        # Yields native items in seq order, starting at seq start, while
+        # holding at most page_size rows in memory. Each page is fetched
+        # with its own short session, seeking past the last seq seen, so
+        # concurrent updates never invalidate the iterator and the cost of
+        # a page does not grow with its position. seq is assumed to be
+        # unique, as it is for sequences written by update().
+        page_size = page_size or self._db_page_size
+        last = None
+        while True:
+            page = self.window(start=start, count=page_size, after=last)
+            for seq, item in page:
+                yield item
+            if len(page) < page_size:
+                return
+            last = page[-1][0]
+            start = None
+
+    def window(self, start=None, count=None, after=None):
+        # Returns up to count (seq, native item) pairs, in seq order,
+        # beginning at seq start, or just after seq after.
+        session = self.db()
+        try:
+            q = session.query(self.db_model)
+            if start is not None:
+                q = q.filter(self.db_model.seq >= start)
+            if after is not None:
+                q = q.filter(self.db_model.seq > after)
+            q = q.order_by(self.db_model.seq)
+            if count is not None:
+                q = q.limit(count)
+            return [(robj.seq, robj.native()) for robj in q]
+        finally:
+            session.close()
+
+    def count(self):
+        session = self.db()
+        try:
+            return session.query(self.db_model).count()
+        finally:
+            session.close()
+
     def db_get_resources(self, session, seq=None):
         q = session.query(self.db_model)
         if seq is not None: